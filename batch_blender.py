@@ -0,0 +1,422 @@
+import itertools
+import json
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import zlib
+
+from frame_hierarchy_analyzer import all_relations, FrameGraph
+from frame_store import open_store
+from prompts import Prompts
+from instrumentation import metrics, span, count
+
+# Prompt types, and the method of Prompts building each of them
+PROMPT_TYPES = {
+    "zero-shot": "zero_shot_blending",
+    "one-shot": "one_shot_blending",
+    "cot": "cot_blending",
+}
+
+
+def k_hop_pairs(graph: FrameGraph, frame_relation: str, hops: int = 1, frames: list = None):
+    """
+    Get the pairs of frames within a number of steps of each other in a relation, following it
+    in both directions.
+    :param graph: FrameGraph of the frames.
+    :param frame_relation: The relation type, from frame_relations or graph_relations.
+    :param hops: Maximum number of steps between the two frames.
+    :param frames: Only pair these frame names. Defaults to all frames of the graph.
+    :return: Sorted list of (name, other name) tuples, with name < other name.
+    """
+    names = set(frames) if frames is not None else set(graph.nodes)
+    pairs = []
+    for name in sorted(names):
+        for other in graph.neighborhood(name, frame_relation, hops):
+            # each pair once, and only frames with an entry in the index
+            if other > name and other in names and other in graph.nodes:
+                pairs.append((name, other))
+    return sorted(pairs)
+
+def read_frame_list(path: str, known: set):
+    """
+    Reads frame names, one per line. Empty lines and lines starting with "#" are skipped.
+    :param known: Names of the existing frames. Other names are reported and skipped.
+    :return: List of frame names.
+    """
+    frames = []
+    with open(path, 'r') as fo:
+        for line in fo:
+            name = line.strip()
+            if not name or name.startswith("#"):
+                continue
+            if name not in known:
+                print(f"[Warning] Unknown frame skipped: {name}")
+                continue
+            frames.append(name)
+    return frames
+
+def read_combinations(path: str, known: set):
+    """
+    Reads frame combinations, one per line, with the frames separated by commas, e.g. "Travel, Aging".
+    Empty lines and lines starting with "#" are skipped.
+    :param known: Names of the existing frames. Combinations with other names are reported and skipped.
+    :return: List of tuples of frame names.
+    """
+    combinations = []
+    with open(path, 'r') as fo:
+        for number, line in enumerate(fo, 1):
+            if not line.strip() or line.strip().startswith("#"):
+                continue
+            frames = tuple(name.strip() for name in line.split(',') if name.strip())
+            unknown = [name for name in frames if name not in known]
+            if unknown:
+                print(f"[Warning] Line {number} skipped, unknown frames: {', '.join(unknown)}")
+                continue
+            combinations.append(frames)
+    return combinations
+
+def blend_items(combinations: list, prompt_types: list = ["zero-shot"], rhetorical: list = [True]):
+    """
+    Get the blends to generate: each combination of frames with each prompt type and rhetorical option.
+    :return: List of dictionaries with "id", "frames", "prompt_type" and "rhetorical". The id only
+        depends on these, so that it stays the same across runs, shards and machines.
+    """
+    items = []
+    for frames, prompt_type, is_rhetorical in itertools.product(combinations, prompt_types, rhetorical):
+        items.append({
+            "id": f"{'+'.join(frames)}/{prompt_type}/{'rhetorical' if is_rhetorical else 'plain'}",
+            "frames": list(frames),
+            "prompt_type": prompt_type,
+            "rhetorical": is_rhetorical,
+        })
+    return items
+
+def build_prompt(prompts: Prompts, item: dict):
+    return getattr(prompts, PROMPT_TYPES[item["prompt_type"]])(item["frames"], item["rhetorical"])
+
+def parse_shard(shard: str = None):
+    """
+    Parses a shard "i/N", 0 <= i < N. Defaults to the task of a SLURM job array, otherwise "0/1".
+    :return: (i, N).
+    """
+    if shard is None:
+        if "SLURM_ARRAY_TASK_COUNT" not in os.environ:
+            return 0, 1
+        # the array may start at any index, e.g. --array=1-16
+        index = int(os.environ["SLURM_ARRAY_TASK_ID"]) - int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0))
+        return index, int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+    index, _, total = shard.partition('/')
+    index, total = int(index), int(total)
+    assert 0 <= index < total, "Please enter the shard as i/N with 0 <= i < N, e.g. 3/16"
+    return index, total
+
+def in_shard(item: dict, shard: tuple):
+    """
+    Whether an item belongs to a shard. Items are assigned by a hash of their id, so that the
+    shards do not change when other items are added or the enumeration order changes.
+    """
+    index, total = shard
+    return zlib.crc32(item["id"].encode()) % total == index
+
+def shard_path(output: str, shard: tuple):
+    """
+    Get the output file of a shard: "blends.jsonl" becomes "blends.3-of-16.jsonl" for the shard 3/16.
+    """
+    index, total = shard
+    if total == 1:
+        return output
+    root, ext = os.path.splitext(output)
+    return f"{root}.{index}-of-{total}{ext or '.jsonl'}"
+
+def load_checkpoint(path: str):
+    """
+    Reads the blends already written to an output file, so that a run can resume after it was
+    stopped. A last line cut by the interruption is removed from the file.
+    :return: Set of the ids of the blends with a response. Blends that failed are generated again.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as fo:
+        data = fo.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            fo.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if "response" in record:
+            done.add(record["id"])
+    return done
+
+
+class BlendWriter(object):
+    """
+    Appends records to a JSONL file, one line each, written to disk before write() returns so that
+    a preempted job loses no finished blend.
+    """
+
+    def __init__(self, path: str):
+        self.fo = open(path, 'a')
+        self._lock = threading.Lock()
+        return
+
+    def write(self, record: dict):
+        with self._lock:
+            self.fo.write(json.dumps(record) + "\n")
+            self.fo.flush()
+            os.fsync(self.fo.fileno())
+        return
+
+    def close(self):
+        with self._lock:
+            self.fo.close()
+        return
+
+
+class BatchBlender(object):
+    """
+    Generates blends with a pool of workers fed by a bounded queue, writing each result as soon as
+    it is generated. Locally, the models and the index are loaded once and the blends are generated
+    one at a time; with an inference server, several requests are kept in flight so that the server
+    always has the next one queued.
+    """
+
+    def __init__(self, writer: BlendWriter, workers: int = 1, max_in_flight: int = None, server: str = None,
+                 use_cache: bool = False, shard: tuple = (0, 1)):
+        """
+        :param writer: BlendWriter of the output file.
+        :param workers: Number of blends generated concurrently. Always 1 without server, since the
+            local model generates one response at a time.
+        :param max_in_flight: Maximum number of blends queued or being generated. Defaults to twice the workers.
+        :param server: Address of a running inference_server, see inference_server.parse_address().
+            Defaults to loading the models.
+        :param use_cache: Whether to reuse the response to an identical query, see ResponseCache.
+        :param shard: (i, N) recorded with each blend.
+        """
+        if server is None and workers > 1:
+            print("[Warning] Without server, blends are generated one at a time")
+            workers = 1
+        self.writer = writer
+        self.workers = workers
+        # the queue itself is unbounded, the slots limit the blends queued or being generated
+        self.jobs = queue.Queue()
+        self.slots = threading.BoundedSemaphore(max(1, max_in_flight or 2 * workers))
+        self.server = server
+        self.use_cache = use_cache
+        self.shard = f"{shard[0]}/{shard[1]}"
+        self.host = socket.gethostname()
+        self.stopping = threading.Event()
+        self.prompts = Prompts()
+        self.generated = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._engines = set()
+        return
+
+    def load(self, backend=None, threads=None):
+        """
+        Loads the models and the index, or checks that the server is running.
+        """
+        if self.server:
+            from inference_server import RemoteQueryEngine
+            # raises OSError if the server is not running
+            RemoteQueryEngine(self.server).status()
+            return
+        from rag import load_models, get_index
+        load_models(backend, threads)
+        self.index = get_index()
+        self.cache = None
+        if self.use_cache:
+            from response_cache import ResponseCache
+            self.cache = ResponseCache()
+        return
+
+    def generate(self, item: dict):
+        """
+        Generates the response of a blend, retrieving only the chunks of its frames.
+        :return: (response text, stats of the GenerationStream).
+        """
+        prompt = build_prompt(self.prompts, item)
+        if self.server:
+            from inference_server import RemoteQueryEngine
+            query_engine = RemoteQueryEngine(self.server, frames=item["frames"])
+            with self._lock:
+                self._engines.add(query_engine)
+            try:
+                stream = query_engine.stream(prompt, self.use_cache)
+                response = "".join(stream)
+            finally:
+                with self._lock:
+                    self._engines.discard(query_engine)
+        else:
+            from rag import get_query_engine, stream_response
+            query_engine = get_query_engine(streaming=True, frames=item["frames"], index=self.index)
+            # stop() sets the stopping event, which cancels the generation
+            stream = stream_response(query_engine, prompt, self.cache, self.stopping)
+            response = "".join(stream)
+        return prompt, response, stream.stats()
+
+    def work(self, total: int):
+        while not self.stopping.is_set():
+            try:
+                item = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            record = dict(item, shard=self.shard, host=self.host)
+            try:
+                with span("blend", frames=len(item["frames"]), prompt_type=item["prompt_type"]):
+                    record["prompt"], record["response"], record["stats"] = self.generate(item)
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+            finally:
+                # no longer queued or being generated
+                self.slots.release()
+            if self.stopping.is_set():
+                # cut short by stop(), generated again when the run resumes
+                break
+            record["time"] = time.time()
+            try:
+                self.writer.write(record)
+            except OSError as e:
+                print(f"[Error] Cannot write {item['id']}: {e}")
+                self.stop()
+                break
+            with self._lock:
+                if "error" in record:
+                    self.failed += 1
+                else:
+                    self.generated += 1
+                done = self.generated + self.failed
+            if "error" in record:
+                count("batch.failed")
+                print(f"[{done}/{total}] [Error] {item['id']}: {record['error']}")
+            else:
+                count("batch.generated")
+                stats = record["stats"]
+                print(f"[{done}/{total}] {item['id']}: {stats['tokens']} tokens in {stats['total_time']:.1f}s")
+        return
+
+    def run(self, items: list):
+        """
+        Generates the blends of items until they are all written or stop() is called.
+        :return: Whether every blend was generated without error.
+        """
+        threads = [threading.Thread(target=self.work, args=(len(items),), daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for item in items:
+                # blocks while max_in_flight blends are queued or running
+                while not self.stopping.is_set():
+                    if self.slots.acquire(timeout=1):
+                        self.jobs.put(item)
+                        break
+                if self.stopping.is_set():
+                    break
+        except KeyboardInterrupt:
+            self.stop()
+        if not self.stopping.is_set():
+            # after stop(), the workers exit without waiting for the end markers
+            for _ in threads:
+                self.jobs.put(None)
+        for thread in threads:
+            # with a timeout, so that signals are handled while waiting
+            while thread.is_alive():
+                try:
+                    thread.join(timeout=1)
+                except KeyboardInterrupt:
+                    self.stop()
+        return not self.stopping.is_set() and self.failed == 0
+
+    def stop(self):
+        """
+        Stops the run: no new blend is started, and the running generations are cancelled. Called
+        on SIGTERM, e.g. when a SLURM job is preempted or reaches its time limit, and on Ctrl-C.
+        """
+        self.stopping.set()
+        if self.server:
+            with self._lock:
+                engines = list(self._engines)
+            for query_engine in engines:
+                try:
+                    query_engine.cancel()
+                except OSError:
+                    pass
+        return
+
+
+def combinations_from_args(args, graph: FrameGraph):
+    known = set(graph.nodes)
+    if args.combinations:
+        return read_combinations(args.combinations, known)
+    frames = read_frame_list(args.frames, known) if args.frames else None
+    if args.relation:
+        return k_hop_pairs(graph, args.relation, args.hops, frames)
+    return list(itertools.combinations(sorted(set(frames)), 2))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from models import BACKENDS
+
+    parser = argparse.ArgumentParser(description="Generates frame blending examples for many frame combinations, without the terminal interface")
+    parser.add_argument('--relation', type=str, default=None, choices=list(all_relations.keys()), help='Blend the pairs of frames within --hops steps in this relation')
+    parser.add_argument('--hops', type=int, default=1, help='Maximum number of steps between the frames of a pair, with --relation')
+    parser.add_argument('--frames', type=str, default=None, help='File of frame names, one per line: only pair these frames, or all pairs of them without --relation')
+    parser.add_argument('--combinations', type=str, default=None, help='File of frame combinations to blend, one per line, frames separated by commas')
+    parser.add_argument('--prompt', type=str, nargs='+', default=['zero-shot'], choices=list(PROMPT_TYPES.keys()), help='Prompt types, each combination is blended with each of them')
+    parser.add_argument('--rhetorical', type=str, default='on', choices=['on', 'off', 'both'], help='Whether the prompts ask for rhetorical devices')
+    parser.add_argument('--output', type=str, default='blends.jsonl', help='JSONL file to append the blends to. Shards write to blends.<i>-of-<N>.jsonl')
+    parser.add_argument('--shard', type=str, default=None, help='Only generate the shard i/N of the blends (0 <= i < N). Defaults to the task of a SLURM job array')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='Maximum number of blends queued or being generated. Defaults to twice the workers')
+    parser.add_argument('--workers', type=int, default=None, help='Blends generated concurrently with --server. Defaults to 2')
+    parser.add_argument('--server', type=str, default=None, help='Generate with a running inference_server at this address instead of loading the models')
+    parser.add_argument('--cache', action='store_true', help='Reuse the response to an identical query instead of generating a new one')
+    parser.add_argument('--backend', type=str, default=None, choices=BACKENDS, help='Where and how the LLM runs. Defaults to "cuda" if a GPU is available, "cpu-int8" otherwise')
+    parser.add_argument('--threads', type=int, default=None, help='Number of CPU threads of the CPU backends')
+    parser.add_argument('--metrics', type=str, default=None, help='JSONL file to append the timings, token counts and cache hits to')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the blends of the shard that are left to generate')
+    args = parser.parse_args()
+    assert args.relation or args.frames or args.combinations, "Please give --relation, --frames or --combinations"
+
+    shard = parse_shard(args.shard)
+    store = open_store()
+    graph = FrameGraph(store.frames(), store)
+    rhetorical = {"on": [True], "off": [False], "both": [True, False]}[args.rhetorical]
+    items = [item for item in blend_items(combinations_from_args(args, graph), args.prompt, rhetorical) if in_shard(item, shard)]
+    output = shard_path(args.output, shard)
+    done = load_checkpoint(output)
+    pending = [item for item in items if item["id"] not in done]
+    print(f"Shard {shard[0]}/{shard[1]}: {len(items)} blends, {len(items) - len(pending)} already in {output}, {len(pending)} to generate")
+    if args.dry_run:
+        for item in pending:
+            print(item["id"])
+        sys.exit(0)
+
+    if args.metrics:
+        metrics.open_log(args.metrics)
+    writer = BlendWriter(output)
+    blender = BatchBlender(writer, args.workers or (2 if args.server else 1), args.max_in_flight, args.server, args.cache, shard)
+    signal.signal(signal.SIGTERM, lambda signum, frame: blender.stop())
+    try:
+        blender.load(args.backend, args.threads)
+        completed = blender.run(pending)
+    finally:
+        writer.close()
+        if args.metrics:
+            metrics.close_log()
+            metrics.dump(args.metrics)
+    print(f"{blender.generated} blends generated, {blender.failed} failed, written to {output}")
+    if not completed:
+        # the failed and unfinished blends are generated when the command is run again
+        sys.exit(1)
@@ -0,0 +1,425 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, quoteattr
+
+from frame_hierarchy_analyzer import all_relations, frame_relations, get_frames, analyze_hierarchy, FrameGraph, HierarchyView
+from frame_hierarchy_examiner import check_hierarchy
+from framenet_xml_parser import parse
+from frame_store import FrameStore, open_store, STORE_PATH
+from frame_name_index import FrameNameIndex
+
+FRAMENET_NAMESPACE = "http://framenet.icsi.berkeley.edu"
+WORDS = ["agent", "theme", "event", "place", "time", "manner", "goal", "source", "path", "cause",
+         "state", "entity", "person", "object", "action", "result", "degree", "means", "purpose", "instrument"]
+# Queries of the retrieval benchmarks, answered with the index of the generated corpus
+QUERIES = [" ".join(WORDS[i:i + 3]) for i in range(0, len(WORDS), 2)]
+# Slowest completion allowed for the 99th percentile, as frame_blender completes the frame name at each key press
+COMPLETION_TARGET = 0.001
+
+
+def sentence(rng, length):
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+def frame_relation_edges(names, depth, density, cycle_rate, rng):
+    """
+    Generates the relations between frames, as FrameNet records them: both frames of an edge list
+    each other, under the two labels of the relation. For each relation, the frames are shuffled
+    into depth levels, and a frame gets one parent (sometimes two) in the level above with
+    probability density. "Precedence" also gets edges in the other direction, closing loops.
+    :return: Dictionary {frame name: {label: [related frame names]}}.
+    """
+    edges = {name: {} for name in names}
+
+    def add(child, parent, labels):
+        edges[child].setdefault(labels[0], []).append(parent)
+        edges[parent].setdefault(labels[1], []).append(child)
+        return
+
+    for relation, labels in all_relations.items():
+        shuffled = list(names)
+        rng.shuffle(shuffled)
+        size = max(1, -(-len(shuffled) // depth))
+        levels = [shuffled[i:i + size] for i in range(0, len(shuffled), size)]
+        for above, level in zip(levels, levels[1:]):
+            for name in level:
+                if rng.random() >= density:
+                    continue
+                for parent in rng.sample(above, min(len(above), 2 if rng.random() < 0.15 else 1)):
+                    add(name, parent, labels)
+                    if relation == "Precedence" and rng.random() < cycle_rate:
+                        add(parent, name, labels)
+    for related in edges.values():
+        for label in related:
+            related[label] = list(dict.fromkeys(related[label]))
+    return edges
+
+def frame_xml(name, frame_id, relations, rng):
+    """
+    Writes a frame in the format of the FrameNet frame XML files: a definition with annotated
+    examples, frame elements, relations and lexical units.
+    :param relations: Dictionary {label: [related frame names]}.
+    """
+    frame_elements = [f"{rng.choice(WORDS).capitalize()}_{i}" for i in range(rng.randint(2, 8))]
+    lexical_units = [f"{name.lower()}_{i}.{rng.choice('vna')}" for i in range(rng.randint(1, 20))]
+    examples = ""
+    for _ in range(rng.randint(0, 3)):
+        examples += (f'<ex><fex name="{rng.choice(frame_elements)}">{sentence(rng, 2)}</fex> '
+                     f'<t>{lexical_units[0].split(".")[0]}</t> {sentence(rng, 4)}.</ex>')
+    definition = f"<def-root>The <fen>{frame_elements[0]}</fen> {sentence(rng, rng.randint(10, 60))}. {examples}</def-root>"
+    lines = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>',
+             f'<frame cBy="bench" name={quoteattr(name)} ID="{frame_id}" xmlns="{FRAMENET_NAMESPACE}">',
+             f"    <definition>{escape(definition)}</definition>"]
+    for i, frame_element in enumerate(frame_elements):
+        fe_definition = f"<def-root>The <fen>{frame_element}</fen> {sentence(rng, rng.randint(5, 25))}.</def-root>"
+        lines += [f'    <FE abbrev="{frame_element[:3]}" coreType="{"Core" if i < 2 else "Peripheral"}" name="{frame_element}" ID="{frame_id * 100 + i}">',
+                  f"        <definition>{escape(fe_definition)}</definition>",
+                  "    </FE>"]
+    for labels in all_relations.values():
+        for label in labels:
+            related = relations.get(label, [])
+            if not related:
+                lines.append(f'    <frameRelation type="{label}"/>')
+                continue
+            lines.append(f'    <frameRelation type="{label}">')
+            lines += [f'        <relatedFrame ID="{zlib.crc32(other.encode())}">{other}</relatedFrame>' for other in related]
+            lines.append("    </frameRelation>")
+    for i, lexical_unit in enumerate(lexical_units):
+        lines += [f'    <lexUnit status="Created" POS="{lexical_unit[-1].upper()}" name="{lexical_unit}" ID="{frame_id * 100 + i}">',
+                  f"        <definition>COD: {sentence(rng, rng.randint(3, 12))}</definition>",
+                  "    </lexUnit>"]
+    lines.append("</frame>")
+    return "\n".join(lines) + "\n"
+
+def generate_corpus(path, frames=1000, depth=6, density=0.6, cycle_rate=0.1, seed=0):
+    """
+    Generates a synthetic FrameNet-shaped corpus of frame XML files, in path/frame/, so that the
+    benchmarks run without the FrameNet data. The same arguments always generate the same corpus.
+    :param frames: Number of frames.
+    :param depth: Number of levels of the hierarchy of each relation.
+    :param density: Probability that a frame below the top level has a parent in a relation.
+    :param cycle_rate: Probability that an edge of "Precedence" is also added in the other direction.
+    :param seed: Seed of the random generator.
+    :return: Dictionary of the parameters, also written to path/corpus.json.
+    """
+    rng = random.Random(seed)
+    names = [f"Frame_{i:05d}" for i in range(frames)]
+    edges = frame_relation_edges(names, depth, density, cycle_rate, rng)
+    xml_folder_path = os.path.join(path, "frame")
+    os.makedirs(xml_folder_path, exist_ok=True)
+    size = 0
+    for i, name in enumerate(names):
+        text = frame_xml(name, i + 1, edges[name], rng)
+        with open(os.path.join(xml_folder_path, f"{name}.xml"), 'w') as fo:
+            fo.write(text)
+        size += len(text)
+    corpus = {"frames": frames, "depth": depth, "density": density, "cycle_rate": cycle_rate, "seed": seed, "xml_bytes": size}
+    with open(os.path.join(path, "corpus.json"), 'w') as fo:
+        json.dump(corpus, fo, indent=4)
+    return corpus
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Hides the progress bars and messages of the benchmarked functions.
+    """
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+    return
+
+def timed(function, repeat=3, setup=None):
+    """
+    Runs a function several times and measures each run.
+    :param setup: Function run before each run, not measured.
+    :return: ({"best", "median": seconds, "runs": [seconds]}, result of the last run).
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with quiet():
+            start = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times), "runs": times}, result
+
+def bench_parse(results, repeat=3, workers=1):
+    """
+    Times framenet_xml_parser.parse() of the frame folder: full conversions, an incremental run
+    without changes, and packing the frame store.
+    """
+    def clear():
+        shutil.rmtree("frame_json", ignore_errors=True)
+        return
+
+    results["parse"], _ = timed(lambda: parse("frame", "frame_json", incremental=False), repeat, clear)
+    if workers > 1:
+        results[f"parse_workers_{workers}"], _ = timed(lambda: parse("frame", "frame_json", workers=workers, incremental=False), repeat, clear)
+    results["parse_incremental"], _ = timed(lambda: parse("frame", "frame_json"), repeat)
+    results["store_build"], _ = timed(lambda: FrameStore.build("frame_json", STORE_PATH), repeat)
+    return
+
+def bench_hierarchies(results, frames, repeat=3):
+    """
+    Times analyze_hierarchy() of every relation in both directions, check_hierarchy(), and the
+    rendering of and the lookups in the hierarchies.
+    """
+    store = open_store()
+    results["frame_graph"], graph = timed(lambda: FrameGraph(frames, store), repeat)
+    for relation in all_relations:
+        for reverse_order in [False, True]:
+            suffix = f"{relation}{'_reverse' if reverse_order else ''}"
+            results[f"analyze_hierarchy_{suffix}"], root = timed(lambda: analyze_hierarchy(frames, relation, reverse_order, store=store), repeat)
+            results[f"analyze_hierarchy_{suffix}"]["nodes"] = root.count_nodes()
+            if relation in frame_relations:
+                results[f"check_hierarchy_{suffix}"], valid = timed(lambda: check_hierarchy(root, relation, reverse_order, store), repeat)
+                results[f"check_hierarchy_{suffix}"]["valid"] = valid
+            if reverse_order:
+                continue
+            results[f"render_{relation}"], text = timed(lambda: str(root), repeat)
+            results[f"render_{relation}"]["lines"] = text.count("\n") + 1
+            # a screen of lines in the middle, as frame_blender shows them
+            results[f"view_{relation}"], _ = timed(lambda: list(HierarchyView(root).lines(text.count("\n") // 2, 50)), repeat)
+            names = [graph.names[frame] for frame in frames]
+            results[f"find_{relation}"], found = timed(lambda: sum(root.find(name) is not None for name in names), repeat)
+            results[f"find_{relation}"]["lookups"] = len(names)
+            results[f"find_{relation}"]["found"] = found
+    store.close()
+    return
+
+def stub_embed_model(dim=384):
+    """
+    Embedding model hashing the words of a text into a vector, to time the index without loading
+    a model. Texts sharing words get similar embeddings.
+    """
+    from llama_index.core.embeddings import BaseEmbedding
+
+    def embed(text):
+        vector = [0.0] * dim
+        for word in text.lower().split():
+            vector[zlib.crc32(word.encode()) % dim] += 1.0
+        return vector
+
+    class HashEmbedding(BaseEmbedding):
+        def _get_query_embedding(self, query):
+            return embed(query)
+
+        async def _aget_query_embedding(self, query):
+            return embed(query)
+
+        def _get_text_embedding(self, text):
+            return embed(text)
+
+    return HashEmbedding(model_name="hash", embed_batch_size=256)
+
+def bench_retrieval(results, frames, repeat=3, embedder="stub", dtype="float32"):
+    """
+    Times building, loading and querying the index of rag.get_index().
+    :param embedder: "stub" for stub_embed_model(), "local" for the embedding model of models.embed_model().
+    """
+    from llama_index.core import Settings
+    from models import embed_model
+    from rag import get_index, frame_filters, PERSIST_DIR
+
+    # rag logs every step of llama_index at the INFO level
+    logging.getLogger().setLevel(logging.WARNING)
+    Settings.embed_model = stub_embed_model() if embedder == "stub" else embed_model()
+    build = lambda: get_index(dtype=dtype)
+    results["index_build"], index = timed(build, repeat, lambda: shutil.rmtree(PERSIST_DIR, ignore_errors=True))
+    results["index_build"]["chunks"] = len(index.index_struct.nodes_dict)
+    results["index_load"], index = timed(build, repeat)
+    retriever = index.as_retriever(similarity_top_k=4)
+    results["retrieve"], _ = timed(lambda: [retriever.retrieve(query) for query in QUERIES], repeat)
+    results["retrieve"]["queries"] = len(QUERIES)
+    retriever = index.as_retriever(similarity_top_k=4, filters=frame_filters(frames[:2]))
+    results["retrieve_filtered"], _ = timed(lambda: [retriever.retrieve(query) for query in QUERIES], repeat)
+    results["retrieve_filtered"]["queries"] = len(QUERIES)
+    return
+
+def frame_like_names(count, rng):
+    """
+    Generates names shaped like the FrameNet frame names, e.g. "Kavo_setumi": one to four words of
+    syllables joined by underscores, the first one capitalized.
+    """
+    words = ["".join(rng.choice("bcdfghklmnprstvz") + rng.choice("aeiou") for _ in range(rng.randint(1, 5))) for _ in range(count)]
+    names = set()
+    while len(names) < count:
+        names.add("_".join(rng.sample(words, rng.choice([1, 2, 2, 2, 3, 4]))).capitalize())
+    return sorted(names)
+
+def mistype(name, rng):
+    """
+    Makes one or two typing mistakes in a name: a wrong, missing or extra character, or two swapped ones.
+    """
+    chars = list(name)
+    for _ in range(rng.randint(1, 2)):
+        i = rng.randrange(len(chars))
+        mistake = rng.choice(["wrong", "missing", "extra", "swapped"])
+        if mistake == "wrong":
+            chars[i] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+        elif mistake == "missing" and len(chars) > 1:
+            del chars[i]
+        elif mistake == "extra":
+            chars.insert(i, rng.choice("abcdefghijklmnopqrstuvwxyz"))
+        elif i + 1 < len(chars):
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    return "".join(chars)
+
+def bench_completion(results, repeat=3, names=1200):
+    """
+    Times FrameNameIndex.complete() of names being typed, mistyped or not, on as many names shaped
+    like the FrameNet frame names as FrameNet has frames (the generated frames are all named Frame_N).
+    Also records the 99th percentile of single completions, and whether it meets COMPLETION_TARGET.
+    """
+    rng = random.Random(0)
+    names = frame_like_names(names, rng)
+    queries = []
+    for name in rng.sample(names, 500):
+        typed = mistype(name, rng) if rng.random() < 0.7 else name
+        queries.append(typed[:rng.randint(1, len(typed))] if rng.random() < 0.3 else typed)
+    results["name_index_build"], index = timed(lambda: FrameNameIndex(names), repeat)
+    latencies = []
+
+    def complete_all():
+        for query in queries:
+            start = time.perf_counter()
+            index.complete(query)
+            latencies.append(time.perf_counter() - start)
+        return
+
+    results["complete"], _ = timed(complete_all, repeat)
+    latencies.sort()
+    results["complete"]["queries"] = len(queries)
+    results["complete"]["p99"] = latencies[int(len(latencies) * 0.99)]
+    results["complete"]["within_target"] = results["complete"]["p99"] <= COMPLETION_TARGET
+    return
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+
+def run(corpus_path, repeat=3, workers=1, embedder="stub", retrieval=True):
+    """
+    Runs the benchmarks on a corpus from generate_corpus(). The work files (JSON folder, frame
+    store and index) are written into the corpus folder.
+    :param embedder: See bench_retrieval().
+    :param retrieval: Whether to run the retrieval benchmarks, which need llama_index.
+    :return: Dictionary {"corpus", "environment", "results": {benchmark: timings}}, times in seconds.
+    """
+    with open(os.path.join(corpus_path, "corpus.json"), 'r') as fo:
+        corpus = json.load(fo)
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(corpus_path)
+    try:
+        bench_parse(results, repeat, workers)
+        frames = sorted(get_frames("frame"))
+        bench_hierarchies(results, frames, repeat)
+        bench_completion(results, repeat)
+        if retrieval:
+            bench_retrieval(results, frames, repeat, embedder)
+    finally:
+        os.chdir(cwd)
+    return {"corpus": corpus, "environment": {**environment(), "repeat": repeat, "workers": workers, "embedder": embedder}, "results": results}
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Prints the change of the best time of each benchmark between two runs.
+    :param baseline: Results of run(), e.g. loaded from a previous output file.
+    :param threshold: Relative slowdown above which a benchmark counts as a regression.
+    :return: List of the names of the regressed benchmarks.
+    """
+    if baseline["corpus"] != current["corpus"]:
+        print("[Warning] The runs used different corpora, the times are not comparable")
+    regressions = []
+    print(f"{'benchmark':<45}{'baseline':>12}{'current':>12}")
+    for name, timings in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<45}{'new':>12}{timings['best']:>12.4f}")
+            continue
+        change = timings["best"] / before["best"] - 1 if before["best"] > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  slower"
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:<45}{before['best']:>12.4f}{timings['best']:>12.4f}{change:>+9.1%}{flag}")
+    return regressions
+
+def print_results(output):
+    corpus = output["corpus"]
+    print(f"{corpus['frames']} frames, depth {corpus['depth']}, {corpus['xml_bytes'] / 1e6:.1f} MB of XML")
+    for name, timings in output["results"].items():
+        print(f"{name:<45}{timings['best']:>12.4f}s  (median {timings['median']:.4f}s)")
+    return
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Times the parser, the hierarchies and the retrieval on a synthetic FrameNet corpus")
+    parser.add_argument('--frames', type=int, default=1000, help='Number of generated frames')
+    parser.add_argument('--depth', type=int, default=6, help='Number of levels of the hierarchy of each relation')
+    parser.add_argument('--density', type=float, default=0.6, help='Probability that a frame has a parent in a relation')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus generator')
+    parser.add_argument('--corpus', type=str, default=None, help='Folder to generate the corpus in and keep. Defaults to a temporary folder')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='Also time parsing with this many processes')
+    parser.add_argument('--embedder', type=str, default='stub', choices=['stub', 'local'], help='Embedding model of the retrieval benchmarks')
+    parser.add_argument('--no-retrieval', action='store_true', help='Skip the retrieval benchmarks')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='File to write the results to')
+    parser.add_argument('--compare', type=str, default=None, help='Results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    corpus_path = args.corpus or tempfile.mkdtemp(prefix="framenet_bench_")
+    try:
+        generate_corpus(corpus_path, args.frames, args.depth, args.density, seed=args.seed)
+        output = run(corpus_path, args.repeat, args.workers, args.embedder, not args.no_retrieval)
+    finally:
+        if args.corpus is None:
+            shutil.rmtree(corpus_path, ignore_errors=True)
+    with open(args.output, 'w') as fo:
+        json.dump(output, fo, indent=4)
+    print_results(output)
+    print(f"Results saved to {args.output}")
+    failed = False
+    completion = output["results"]["complete"]
+    if not completion["within_target"]:
+        print(f"[Error] 99% of the completions take up to {completion['p99'] * 1000:.2f}ms, above the target of {COMPLETION_TARGET * 1000:.0f}ms")
+        failed = True
+    if args.compare:
+        with open(args.compare, 'r') as fo:
+            baseline = json.load(fo)
+        regressions = compare(baseline, output, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmarks slower than {args.compare} by more than {args.threshold:.0%}")
+            failed = True
+    if failed:
+        sys.exit(1)
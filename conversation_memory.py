@@ -0,0 +1,98 @@
+from collections import deque
+
+
+def approximate_tokens(text: str):
+    """
+    Estimates the number of tokens of a text when no tokenizer is available: about 4 characters per token.
+    """
+    return len(text) // 4 + 1
+
+
+class ConversationMemory(object):
+    """
+    History of a conversation, formatted into the prompts of the next turns. The tokens of each turn
+    are counted once, when it is added, and the oldest turns are dropped to keep the history under
+    a token budget. Dropped turns can be compacted into a summary kept at the start of the history.
+    """
+
+    def __init__(self, max_tokens: int = 1024, count_tokens=None, summarize=None):
+        """
+        :param max_tokens: Token budget of the history and the new prompt together. The retrieved
+            context, the system prompt and the response need to fit in the rest of the model's context window.
+        :param count_tokens: Function counting the tokens of a text, e.g. with the model's tokenizer.
+            Defaults to approximate_tokens().
+        :param summarize: Function(summary, text) returning a new summary of the previous summary and
+            the dropped turns, e.g. rag.conversation_summarizer(). Defaults to dropping the turns.
+        """
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or approximate_tokens
+        self.summarize = summarize
+        # turns[i]: (role, content, formatted line, number of tokens of the line)
+        self.turns = deque()
+        self.tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        return
+
+    def __len__(self):
+        return len(self.turns)
+
+    @staticmethod
+    def format_turn(role, content):
+        return f"User: {content}" if role == "user" else f"Assistant: {content}"
+
+    def add(self, role: str, content: str):
+        """
+        Adds a turn to the history.
+        :param role: "user" or "assistant".
+        :param content: Text of the turn, e.g. the user prompt or str() of the response.
+        """
+        line = self.format_turn(role, str(content))
+        # one more token for the line break
+        tokens = self.count_tokens(line) + 1
+        self.turns.append((role, str(content), line, tokens))
+        self.tokens += tokens
+        return
+
+    def messages(self):
+        """
+        Get the turns in the history, oldest first.
+        :return: List of {"role": ..., "content": ...}.
+        """
+        return [{"role": role, "content": content} for role, content, _, _ in self.turns]
+
+    def fit(self, reserved_tokens: int = 0):
+        """
+        Drops the oldest turns until the history fits in the budget with reserved_tokens left, e.g.
+        for the next prompt. When summarizing, turns are dropped down to 3/4 of the budget, so that a
+        summary is not written at every turn.
+        """
+        budget = self.max_tokens - reserved_tokens
+        if self.tokens + self.summary_tokens <= budget:
+            return
+        target = budget * 3 // 4 if self.summarize else budget
+        dropped = []
+        while self.turns and self.tokens + self.summary_tokens > target:
+            role, content, line, tokens = self.turns.popleft()
+            self.tokens -= tokens
+            dropped.append(line)
+        if self.summarize and dropped:
+            self.summary = self.summarize(self.summary, "\n".join(dropped))
+            self.summary_tokens = self.count_tokens(self.summary) + 1
+        if self.summary and self.tokens + self.summary_tokens > budget:
+            # the summary does not fit anymore, it is dropped with the turns it covers
+            self.summary, self.summary_tokens = "", 0
+        return
+
+    def prompt(self, prompt: str):
+        """
+        Formats a new prompt after the history, dropping the oldest turns if needed. The prompt itself
+        is not added to the history, see add().
+        :return: Full prompt, ending with "Assistant:".
+        """
+        current = f"User: {prompt}\nAssistant:"
+        self.fit(self.count_tokens(current))
+        lines = [f"Summary of the earlier conversation: {self.summary}"] if self.summary else []
+        lines += [line for _, _, line, _ in self.turns]
+        lines.append(current)
+        return "\n".join(lines)
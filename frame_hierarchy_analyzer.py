@@ -1,8 +1,13 @@
-import json
 import os
+import json
+import pickle
+import hashlib
+from bisect import bisect_right
+from frame_store import open_store
+from instrumentation import span, count
 
 # A dictionary mapping frame relations to their verbal descriptors.
-# Currently do not contain "Precedes", "Is Preceded by", "Is Inchoative of", "Is Causative of".
+# Does not contain "Precedes", "Is Preceded by", "Is Inchoative of", "Is Causative of", see graph_relations.
 # "Precedes", "Is Preceded by": contain loops (e.g. Waking_up, Process_continue)
 # "Is Inchoative of", "Is Causative of": do not correspond one-to-one (e.g. Awareness & Coming_to_believe)
 frame_relations = {
@@ -12,6 +17,59 @@ frame_relations = {
     "Subframe": ["Subframe of", "Has Subframe(s)"],
 }
 
+# Relations that are only built as graphs (see FrameGraph.graph_hierarchy): the edges of both
+# labels are merged, and edges closing a loop are cut so that the hierarchy stays finite.
+graph_relations = {
+    "Precedence": ["Is Preceded by", "Precedes"],
+    "Causative": ["Is Inchoative of", "Is Causative of"],
+}
+all_relations = {**frame_relations, **graph_relations}
+
+class ChildDict(dict):
+    """
+    Dictionary of the children of a FrameNode, mapping frame names to nodes. Counts its
+    changes so that caches built from it can tell when they are stale.
+    """
+
+    version = 0
+
+    def __setitem__(self, key, value):
+        self.version += 1
+        super().__setitem__(key, value)
+        return
+
+    def __delitem__(self, key):
+        self.version += 1
+        super().__delitem__(key)
+        return
+
+    def pop(self, *args):
+        self.version += 1
+        return super().pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.version += 1
+        super().update(*args, **kwargs)
+        return
+
+    def clear(self):
+        self.version += 1
+        super().clear()
+        return
+
+    def __ior__(self, other):
+        self.version += 1
+        return super().__ior__(other)
+
+
 class FrameNode(object):
     """
     Represents a node in a frame hierarchy. Each node corresponds to a frame.
@@ -23,7 +81,7 @@ class FrameNode(object):
         :param name: Name of the frame.
         """
         self.name = name
-        self.next = {}
+        self.next = ChildDict()
         assert encoding in ["utf-8", "ascii"]
         self.encoding = encoding
         return
@@ -33,39 +91,84 @@ class FrameNode(object):
         Returns the string representation of the node hierarchy.
         """
         return self._str_helper()
+
+    def __getstate__(self):
+        # caches are rebuilt on demand instead of being pickled
+        state = self.__dict__.copy()
+        state.pop("_sorted_cache", None)
+        state.pop("_index", None)
+        return state
+
+    def __setstate__(self, state):
+        # hierarchies pickled before ChildDict existed hold plain dictionaries
+        self.__dict__.update(state)
+        if type(self.next) is dict:
+            self.next = ChildDict(self.next)
+        return
     
     def _sorted_next_list(self):
         """
-        Helper function to get a list of child nodes sorted by name.
+        Helper function to get a list of child nodes sorted by name. The list is cached
+        until the children change.
         :return: List of child FrameNodes.
         """
-        return [item[1] for item in sorted(self.next.items())]
+        version = getattr(self.next, "version", None)
+        if version is None:
+            # a plain dictionary assigned from outside cannot tell when it changes
+            return [item[1] for item in sorted(self.next.items())]
+        cache = self.__dict__.get("_sorted_cache")
+        if cache is None or cache[0] is not self.next or cache[1] != version:
+            cache = (self.next, version, [item[1] for item in sorted(self.next.items())])
+            self._sorted_cache = cache
+        return cache[2]
+
+    def _line(self, is_head, prefix, is_tail):
+        """
+        Helper function to get the line of this node in the string representation.
+        """
+        if is_head:
+            return self.name
+        if self.encoding == "utf-8":
+            return prefix + ("└── " if is_tail else "├── ") + self.name
+        return prefix + ("+-- " if is_tail else "+-- ") + self.name
+
+    def _child_prefix(self, is_head, prefix, is_tail):
+        """
+        Helper function to get the prefix of the lines of this node's children.
+        """
+        if is_head:
+            return prefix
+        if self.encoding == "utf-8":
+            return prefix + ("    " if is_tail else "│   ")
+        return prefix + ("    " if is_tail else "|   ")
+
+    def lines(self, is_head=True, prefix="", is_tail=False):
+        """
+        Generates the lines of the string representation of the node hierarchy one by one.
+        :param is_head: Indicates if the current node is the root.
+        :param prefix: String prefix for each line of the hierarchy.
+        :param is_tail: Indicates if the current node is the last child.
+        :return: Iterator of lines without line breaks.
+        """
+        stack = [(self, is_head, prefix, is_tail)]
+        while stack:
+            node, is_head, prefix, is_tail = stack.pop()
+            yield node._line(is_head, prefix, is_tail)
+            children = node._sorted_next_list()
+            child_prefix = node._child_prefix(is_head, prefix, is_tail)
+            for i in range(len(children) - 1, -1, -1):
+                stack.append((children[i], False, child_prefix, i == len(children) - 1))
+        return
     
     def _str_helper(self, is_head=True, prefix="", is_tail=False):
         """
-        Recursive helper function to generate a string representation of the node hierarchy.
+        Helper function to generate a string representation of the node hierarchy.
         :param is_head: Indicates if the current node is the root.
         :param prefix: String prefix for each line of the hierarchy.
         :param is_tail: Indicates if the current node is the last child.
         :return: Formatted string representation of the node hierarchy.
         """
-        if is_head:
-            result = self.name + '\n'
-        else:
-            if self.encoding == "utf-8":
-                result = prefix + ("└── " if is_tail else "├── ") + self.name + '\n'
-            else:
-                result = prefix + ("+-- " if is_tail else "+-- ") + self.name + '\n'
-        for i, node in enumerate(self._sorted_next_list()):
-            if is_head:
-                new_prefix = prefix
-            else:
-                if self.encoding == "utf-8":
-                    new_prefix = prefix + ("    " if is_tail else "│   ")
-                else:
-                    new_prefix = prefix + ("    " if is_tail else "|   ")
-            result += node._str_helper(False, new_prefix, i == len(self.next) - 1)
-        return result
+        return "".join(line + '\n' for line in self.lines(is_head, prefix, is_tail))
     
     def find(self, node_name: str):
         """
@@ -73,12 +176,16 @@ class FrameNode(object):
         :param node_name: Name of the node to find.
         :return: The node if found, None otherwise.
         """
-        if self.name == node_name:
-            return self
-        for node in self.next.values():
-            result = node.find(node_name)
-            if result:
-                return result
+        visited = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.name == node_name:
+                return node
+            if node in visited:
+                continue
+            visited.add(node)
+            stack.extend(reversed(node.children()))
         return None
     
     def delete(self, node_name: str):
@@ -86,7 +193,7 @@ class FrameNode(object):
         Deletes a node by name from the children of the current node.
         :param node_name: Name of the node to delete.
         """
-        self.next = {key:val for key, val in self.next.items() if key != node_name}
+        self.next = ChildDict((key, val) for key, val in self.next.items() if key != node_name)
         return
     
     def count_nodes(self):
@@ -94,7 +201,21 @@ class FrameNode(object):
         Counts the total number of nodes in the subtree including this node.
         :return: Total number of nodes.
         """
-        return 1 + sum([subnode.count_nodes() for subnode in self.next.values()])
+        counts = {}
+        on_path = set()
+        stack = [(self, False)]
+        while stack:
+            node, is_visited = stack.pop()
+            if is_visited:
+                on_path.discard(node)
+                counts[node] = 1 + sum(counts.get(subnode, 0) for subnode in node.next.values() if subnode not in on_path)
+                continue
+            if node in counts:
+                continue
+            on_path.add(node)
+            stack.append((node, True))
+            stack.extend((subnode, False) for subnode in node.next.values() if subnode not in counts and subnode not in on_path)
+        return counts[self]
     
     def children(self):
         """
@@ -108,6 +229,12 @@ class RootFrameNode(FrameNode):
     Specialized FrameNode that acts as the root of a frame hierarchy.
     """
 
+    # Map of frame names to nodes, set when the hierarchy is built from a FrameGraph
+    nodes = None
+    # Edges (parent, child) left out to break loops, set for graph relations
+    cut_edges = ()
+    _index = None
+
     def append_root(self, node: FrameNode, parents: list=[]):
         """
         Appends a node to the root or under specified parent nodes.
@@ -124,6 +251,449 @@ class RootFrameNode(FrameNode):
             if node in self.next.values():
                 self.delete(node.name)
         return
+
+    def find(self, node_name: str):
+        """
+        Finds a node by name within the hierarchy. Uses the name map when the hierarchy
+        was built from a FrameGraph, otherwise searches the tree.
+        :param node_name: Name of the node to find.
+        :return: The node if found, None otherwise.
+        """
+        if self.nodes is None:
+            return super().find(node_name)
+        if self.name == node_name:
+            return self
+        return self.nodes.get(node_name)
+
+    def index(self):
+        """
+        Get the query index of the hierarchy, built on first use. The index is not updated
+        if the hierarchy is modified afterwards.
+        :return: HierarchyIndex of this hierarchy.
+        """
+        if self._index is None:
+            self._index = HierarchyIndex(self)
+        return self._index
+
+
+class HierarchyIndex(object):
+    """
+    Precomputed Euler tour of a hierarchy for ancestor, path, lowest common ancestor and
+    subtree size queries. Frames with several parents appear once under each of them, as
+    in the printed hierarchy.
+    """
+
+    def __init__(self, root: FrameNode):
+        """
+        Traverses the hierarchy iteratively, with children sorted by name.
+        :param root: Root node of the hierarchy.
+        """
+        self.root = root
+        self.names = []       # node name of each occurrence, in preorder
+        self.parents = []     # occurrence of the parent, -1 for the root
+        self.depths = []      # depth of each occurrence, 0 for the root
+        self.ends = []        # the subtree of occurrence i spans occurrences [i, ends[i])
+        self.occurrences = {} # node name -> occurrences in preorder
+        self.euler = []       # Euler tour of occurrences
+        self.first = []       # position of each occurrence's first visit in the Euler tour
+        self._sparse_table = None
+
+        on_path = set()
+        stack = [(root, self._visit(root.name, -1, 0), iter(root._sorted_next_list()))]
+        on_path.add(root)
+        while stack:
+            node, occurrence, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                on_path.discard(node)
+                self.ends[occurrence] = len(self.names)
+                if stack:
+                    self.euler.append(stack[-1][1])
+                continue
+            # a frame already on the path is a cycle, it is not expanded again
+            if child in on_path:
+                continue
+            on_path.add(child)
+            stack.append((child, self._visit(child.name, occurrence, self.depths[occurrence] + 1), iter(child._sorted_next_list())))
+        return
+
+    def _visit(self, name, parent, depth):
+        occurrence = len(self.names)
+        self.names.append(name)
+        self.parents.append(parent)
+        self.depths.append(depth)
+        self.ends.append(occurrence + 1)
+        self.occurrences.setdefault(name, []).append(occurrence)
+        self.first.append(len(self.euler))
+        self.euler.append(occurrence)
+        return occurrence
+
+    def __contains__(self, name):
+        return name in self.occurrences and name != self.root.name
+
+    def _first(self, name):
+        assert name in self.occurrences, f"Frame '{name}' is not in the hierarchy"
+        return self.occurrences[name][0]
+
+    def is_ancestor(self, ancestor: str, descendant: str):
+        """
+        Checks whether a frame is a (strict) ancestor of another frame in the hierarchy.
+        :param ancestor: Name of the possible ancestor.
+        :param descendant: Name of the possible descendant.
+        :return: True if any occurrence of descendant is inside the subtree of ancestor.
+        """
+        if ancestor not in self.occurrences or descendant not in self.occurrences:
+            return False
+        starts = self.occurrences[ancestor]
+        for occurrence in self.occurrences[descendant]:
+            i = bisect_right(starts, occurrence) - 1
+            if i >= 0 and starts[i] < occurrence < self.ends[starts[i]]:
+                return True
+        return False
+
+    def path(self, name: str):
+        """
+        Get the path from the top of the hierarchy to the first occurrence of a frame.
+        :param name: Frame name.
+        :return: List of frame names, starting with a top-level frame and ending with name.
+        """
+        result = []
+        occurrence = self._first(name)
+        while occurrence > 0:
+            result.append(self.names[occurrence])
+            occurrence = self.parents[occurrence]
+        return result[::-1]
+
+    def depth(self, name: str):
+        """
+        Get the depth of the first occurrence of a frame, 1 for top-level frames.
+        """
+        return self.depths[self._first(name)]
+
+    def subtree_size(self, name: str):
+        """
+        Counts the nodes in the subtree of a frame including itself, as FrameNode.count_nodes does.
+        """
+        occurrence = self._first(name)
+        return self.ends[occurrence] - occurrence
+
+    def descendants(self, name: str):
+        """
+        Get the names of all frames below a frame.
+        """
+        occurrence = self._first(name)
+        return set(self.names[occurrence + 1:self.ends[occurrence]])
+
+    def ancestors(self, name: str):
+        """
+        Get the names of all frames above a frame, over all of its occurrences.
+        """
+        result = set()
+        for occurrence in self.occurrences.get(name, []):
+            occurrence = self.parents[occurrence]
+            while occurrence > 0:
+                result.add(self.names[occurrence])
+                occurrence = self.parents[occurrence]
+        return result
+
+    def _build_sparse_table(self):
+        depths = [self.depths[occurrence] for occurrence in self.euler]
+        table = [list(range(len(self.euler)))]
+        width = 1
+        while width * 2 <= len(self.euler):
+            previous = table[-1]
+            row = []
+            for i in range(len(self.euler) - width * 2 + 1):
+                left, right = previous[i], previous[i + width]
+                row.append(left if depths[left] <= depths[right] else right)
+            table.append(row)
+            width *= 2
+        self._euler_depths = depths
+        self._sparse_table = table
+        return
+
+    def _lca_occurrence(self, a, b):
+        if self._sparse_table is None:
+            self._build_sparse_table()
+        left, right = sorted((self.first[a], self.first[b]))
+        level = (right - left + 1).bit_length() - 1
+        i, j = self._sparse_table[level][left], self._sparse_table[level][right - (1 << level) + 1]
+        return self.euler[i if self._euler_depths[i] <= self._euler_depths[j] else j]
+
+    def lowest_common_ancestor(self, a: str, b: str):
+        """
+        Finds the deepest frame that has both frames in its subtree (a frame counts as its own ancestor).
+        :param a: Name of the first frame.
+        :param b: Name of the second frame.
+        :return: Name of the lowest common ancestor, or None if the frames only meet at the root.
+        """
+        self._first(a), self._first(b)
+        best = 0
+        for occurrence_a in self.occurrences[a]:
+            for occurrence_b in self.occurrences[b]:
+                candidate = self._lca_occurrence(occurrence_a, occurrence_b)
+                if self.depths[candidate] > self.depths[best]:
+                    best = candidate
+        return self.names[best] if best > 0 else None
+
+
+class FrameGraph(object):
+    """
+    Index of the relations between frames, built once from every frame's "fr_rel".
+    Hierarchies of any relation and direction are derived from it without reading frames again.
+    """
+
+    def __init__(self, frames: list, store = None):
+        """
+        Reads the names and relations of the frames and builds the adjacency lists.
+        :param frames: List of frame names to include in the graph.
+        :param store: Frame store to read frames from. Defaults to frame_store.open_store().
+        """
+        with span("frame_graph", frames=len(frames)):
+            if store is None:
+                store = open_store()
+            frame_names = store.load("frame_name", frames)
+            frame_rels = store.load("fr_rel", frames)
+            self.frames = list(frames)
+            self.names = {frame: frame_names[frame].strip() for frame in self.frames}
+            self.nodes = {name: frame for frame, name in self.names.items()}
+            # forward[label][name]: frames listed under the label in the frame's "fr_rel"
+            # reverse[label][name]: frames whose "fr_rel" list the frame under the label
+            self.forward = {}
+            self.reverse = {}
+            for labels in all_relations.values():
+                for label in labels:
+                    self.forward[label] = {}
+                    self.reverse[label] = {}
+            for frame in self.frames:
+                name = self.names[frame]
+                for label in self.forward:
+                    related = frame_rels[frame].get(label)
+                    related = [other.strip() for other in related.split(', ')] if related else []
+                    self.forward[label][name] = related
+                    for other in related:
+                        self.reverse[label].setdefault(other, []).append(name)
+        self._edges = {}
+        return
+
+    def related(self, name: str, label: str):
+        """
+        Get the frames listed under a relation label (e.g. "Inherits from") of a frame.
+        :param name: Frame name.
+        :param label: Relation label as it appears in "fr_rel".
+        :return: List of frame names.
+        """
+        return self.forward[label].get(name, [])
+
+    def referencing(self, name: str, label: str):
+        """
+        Get the frames that list a frame under a relation label.
+        :param name: Frame name.
+        :param label: Relation label as it appears in "fr_rel".
+        :return: List of frame names.
+        """
+        return self.reverse[label].get(name, [])
+
+    def edges(self, frame_relation: str, reverse_order: bool = False):
+        """
+        Get the edges of a relation as adjacency lists, merging both of its labels: a frame's
+        children are the frames it lists under the second label and the frames listing it under
+        the first one.
+        :param frame_relation: The relation type, from frame_relations or graph_relations.
+        :param reverse_order: Whether to reverse the order of the relation.
+        :return: Dictionary mapping each frame name to the list of its children's names.
+        """
+        assert frame_relation in all_relations, f'''Please enter one of the relations: ['{"', '".join(all_relations.keys())}']'''
+        key = (frame_relation, reverse_order)
+        if key not in self._edges:
+            parent_label, child_label = all_relations[frame_relation][::-1 if reverse_order else 1]
+            edges = {}
+            for frame in self.frames:
+                name = self.names[frame]
+                edges.setdefault(name, {})
+                for parent in self.forward[parent_label][name]:
+                    edges.setdefault(parent, {})[name] = None
+                for child in self.forward[child_label][name]:
+                    edges[name][child] = None
+                    edges.setdefault(child, {})
+            self._edges[key] = {name: list(children) for name, children in edges.items()}
+        return self._edges[key]
+
+    def _tarjan(self, edges: dict):
+        """
+        Helper function to find the strongly connected components of a graph with an
+        iterative version of Tarjan's algorithm, in time linear to the number of edges.
+        :param edges: Adjacency lists of the graph.
+        :return: (list of components in reverse topological order, dictionary mapping each
+            node to its visiting order, dictionary mapping each node to its component index)
+        """
+        order = {}
+        low = {}
+        component_of = {}
+        components = []
+        stack = []
+        for start in edges:
+            if start in order:
+                continue
+            order[start] = low[start] = len(order)
+            stack.append(start)
+            work = [(start, iter(edges[start]))]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in order:
+                        order[child] = low[child] = len(order)
+                        stack.append(child)
+                        work.append((child, iter(edges[child])))
+                        break
+                    if child not in component_of:
+                        # child is still on the stack
+                        low[node] = min(low[node], order[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == order[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            component_of[member] = len(components)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(component)
+        return components, order, component_of
+
+    def components(self, frame_relation: str):
+        """
+        Finds the loops of a relation, i.e. its strongly connected components.
+        :param frame_relation: The relation type, from frame_relations or graph_relations.
+        :return: List of components, each a list of frame names. Components of more than one
+            frame (or a frame related to itself) are loops.
+        """
+        return self._tarjan(self.edges(frame_relation))[0]
+
+    def condensation(self, frame_relation: str, reverse_order: bool = False):
+        """
+        Condenses each loop of a relation into a single node, which leaves a graph without loops.
+        :param frame_relation: The relation type, from frame_relations or graph_relations.
+        :param reverse_order: Whether to reverse the order of the relation.
+        :return: (list of components, dictionary mapping each frame name to its component index,
+            list of the sorted child component indexes of each component)
+        """
+        edges = self.edges(frame_relation, reverse_order)
+        components, _, component_of = self._tarjan(edges)
+        children = [set() for _ in components]
+        for name, related in edges.items():
+            for child in related:
+                if component_of[name] != component_of[child]:
+                    children[component_of[name]].add(component_of[child])
+        return components, component_of, [sorted(child_set) for child_set in children]
+
+    def neighborhood(self, name: str, frame_relation: str, depth: int = 1, reverse_order: bool = None):
+        """
+        Finds the frames within a number of steps from a frame, following each frame at most once.
+        :param name: Frame name.
+        :param frame_relation: The relation type, from frame_relations or graph_relations.
+        :param depth: Maximum number of steps.
+        :param reverse_order: Direction to follow: False for children, True for parents, None for both.
+        :return: Dictionary mapping each frame reached (including the frame itself) to its number of steps.
+        """
+        directions = [reverse_order] if reverse_order is not None else [False, True]
+        adjacency = [self.edges(frame_relation, direction) for direction in directions]
+        distances = {name: 0}
+        frontier = [name]
+        for step in range(1, depth + 1):
+            next_frontier = []
+            for node in frontier:
+                for edges in adjacency:
+                    for other in edges.get(node, []):
+                        if other not in distances:
+                            distances[other] = step
+                            next_frontier.append(other)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return distances
+
+    def graph_hierarchy(self, frame_relation: str, reverse_order: bool = False, encoding: str = "utf-8"):
+        """
+        Builds the hierarchy of a relation that may contain loops. Within each loop, edges back
+        to a frame visited earlier are cut, so every frame is kept and the hierarchy is finite.
+        The cut edges are kept in root.cut_edges.
+        :param frame_relation: The relation type, from frame_relations or graph_relations.
+        :param reverse_order: Whether to reverse the order of the relation.
+        :return: Root node of the constructed hierarchy.
+        """
+        edges = self.edges(frame_relation, reverse_order)
+        _, order, component_of = self._tarjan(edges)
+        root = RootFrameNode(f"[{all_relations[frame_relation][1 if not reverse_order else 0]}]", encoding=encoding)
+        nodes = {name: FrameNode(name, encoding=encoding) for name in edges}
+        has_parent = set()
+        cut_edges = []
+        for name, children in edges.items():
+            for child in children:
+                if component_of[name] != component_of[child] or order[name] < order[child]:
+                    nodes[name].next[child] = nodes[child]
+                    has_parent.add(child)
+                else:
+                    cut_edges.append((name, child))
+        for name, node in nodes.items():
+            if name not in has_parent:
+                root.next[name] = node
+        root.nodes = nodes
+        root.cut_edges = cut_edges
+        return root
+
+    def hierarchy(self, frame_relation: str, reverse_order: bool = False, encoding: str = "utf-8"):
+        """
+        Builds the frame hierarchy of a relation in one pass over the frames.
+        :param frame_relation: The relation type to build the hierarchy.
+            Choose from: ["Inheritance", "Perspective", "Usage", "Subframe", "Precedence", "Causative"]
+        :param reverse_order: Whether to reverse the order of the relation.
+        :return: Root node of the constructed hierarchy.
+        """
+        with span("hierarchy", relation=frame_relation, reverse_order=reverse_order):
+            if frame_relation in graph_relations:
+                return self.graph_hierarchy(frame_relation, reverse_order, encoding)
+            return self.tree_hierarchy(frame_relation, reverse_order, encoding)
+
+    def tree_hierarchy(self, frame_relation: str, reverse_order: bool = False, encoding: str = "utf-8"):
+        """
+        Builds the hierarchy of one of frame_relations, where each frame is listed under its parents.
+        """
+        assert frame_relation in frame_relations, f'''Please enter one of the relations: ['{"', '".join(all_relations.keys())}']'''
+        parent_label = frame_relations[frame_relation][0 if not reverse_order else 1]
+        root = RootFrameNode(f"[{frame_relations[frame_relation][1 if not reverse_order else 0]}]", encoding=encoding)
+        nodes = {}
+        for frame in self.frames:
+            frame_name = self.names[frame]
+            is_node_existing = frame_name in root.next
+            if is_node_existing:
+                node = root.next[frame_name]
+            else:
+                node = FrameNode(frame_name, encoding=encoding)
+            nodes[frame_name] = node
+            parents = self.forward[parent_label][frame_name]
+
+            # insert node into trees
+            if not parents and not is_node_existing:
+                root.next[frame_name] = node
+            for parent in parents:
+                parent_node = nodes.get(parent)
+                if parent_node is None:
+                    # placeholder for a parent frame that has not been read yet
+                    parent_node = FrameNode(parent, encoding=encoding)
+                    root.next[parent] = parent_node
+                    nodes[parent] = parent_node
+                parent_node.next[frame_name] = node
+                if root.next.get(frame_name) is node:
+                    del root.next[frame_name]
+        root.nodes = nodes
+        return root
+
     
 def get_frames(foldername, suffix=".xml"):
     return [file[:-4] for file in os.listdir(foldername) if file[-4:] == suffix]
@@ -132,46 +702,206 @@ def analyze_hierarchy(
         frames: list, 
         frame_relation: str, 
         reverse_order: bool = False, 
-        encoding: str = "utf-8"
+        encoding: str = "utf-8",
+        store = None,
+        graph: FrameGraph = None
     ):
     """
     Analyzes and builds the frame hierarchy based on the specified relation.
     :param frames: List of frame names to include in the hierarchy.
     :param frame_relation: The relation type to build the hierarchy.
-        Choose from: ["Inheritance", "Perspective", "Usage", "Subframe"]
+        Choose from: ["Inheritance", "Perspective", "Usage", "Subframe", "Precedence", "Causative"]
     :param reverse_order: Whether to reverse the order of the relation.
+    :param store: Frame store to read frames from. Defaults to frame_store.open_store().
+    :param graph: FrameGraph of the frames, to share between hierarchies. Built from the store if not given.
     :return: Root node of the constructed hierarchy.
     """
-    assert frame_relation in frame_relations, f'''Please enter one of the relations: ['{"', '".join(frame_relations.keys())}']'''
-    root = RootFrameNode(f"[{frame_relations[frame_relation][1 if not reverse_order else 0]}]", encoding=encoding)
-    for frame in frames:
-        is_node_existing = False
-        
-        # parse node name and parents
-        with open(f"frame_json/{frame}.json", 'r') as fo:
-            data_dict = json.load(fo)
-        frame_name = data_dict.get("frame_name").strip()
-        if frame_name in root.next.keys():
-            node = root.next[frame_name]
-            is_node_existing = True
-        else:
-            node = FrameNode(data_dict.get("frame_name").strip(), encoding=encoding)
-        parents = data_dict.get("fr_rel").get(frame_relations[frame_relation][0 if not reverse_order else 1])
-        parents = [parent.strip() for parent in parents.split(', ')] if parents else []
-
-        # insert node into trees
-        if not parents and not is_node_existing:
-            root.append_root(node)
-        elif parents:
-            for parent in parents:
-                parent_node = root.find(parent)
-                if parent_node:
-                    parent_node.next[node.name] = node
-                    if node in root.next.values():
-                        root.delete(node.name)
-                else:
-                    root.append_root(node, [parent])
-    return root
+    assert frame_relation in all_relations, f'''Please enter one of the relations: ['{"', '".join(all_relations.keys())}']'''
+    if graph is None:
+        graph = FrameGraph(frames, store)
+    return graph.hierarchy(frame_relation, reverse_order, encoding)
+
+class HierarchyView(object):
+    """
+    Windowed access to the string representation of a node hierarchy. Only the requested
+    lines are generated, whole subtrees before them are skipped using their line counts.
+    """
+
+    def __init__(self, node: FrameNode, memo: dict = None):
+        """
+        :param node: Node at the top of the view.
+        :param memo: Dictionary to share line counts and widths of nodes between views of the same hierarchy.
+        """
+        self.node = node
+        self.memo = memo if memo is not None else {}
+        self._measure(node)
+        return
+
+    def _measure(self, top):
+        """
+        Computes the number of lines and the width of the subtrees under a node, in one
+        iterative pass over the nodes that are not measured yet.
+        """
+        memo = self.memo
+        on_path = set()
+        stack = [(top, False)]
+        while stack:
+            node, is_visited = stack.pop()
+            if is_visited:
+                on_path.discard(node)
+                children = [child for child in node._sorted_next_list() if child not in on_path]
+                size = 1 + sum(memo[child][0] for child in children)
+                width = max([len(node.name)] + [4 + memo[child][1] for child in children])
+                memo[node] = (size, width)
+                continue
+            if node in memo:
+                continue
+            on_path.add(node)
+            stack.append((node, True))
+            stack.extend((child, False) for child in node._sorted_next_list() if child not in memo and child not in on_path)
+        return
+
+    def __len__(self):
+        return self.memo[self.node][0]
+
+    def width(self):
+        """
+        Get the length of the longest line.
+        """
+        return self.memo[self.node][1]
+
+    def lines(self, start: int = 0, count: int = None):
+        """
+        Generates lines [start, start + count) of the string representation of the node hierarchy.
+        :param start: Index of the first line.
+        :param count: Number of lines. Defaults to all lines from start.
+        :return: Iterator of lines without line breaks.
+        """
+        remaining = len(self) - start if count is None else count
+        skip = start
+        stack = [(self.node, True, "", False)]
+        while stack and remaining > 0:
+            node, is_head, prefix, is_tail = stack.pop()
+            size = self.memo[node][0] if node in self.memo else 1
+            if skip >= size:
+                skip -= size
+                continue
+            if skip:
+                skip -= 1
+            else:
+                yield node._line(is_head, prefix, is_tail)
+                remaining -= 1
+            children = node._sorted_next_list()
+            child_prefix = node._child_prefix(is_head, prefix, is_tail)
+            for i in range(len(children) - 1, -1, -1):
+                stack.append((children[i], False, child_prefix, i == len(children) - 1))
+        return
+
+    def line(self, index: int):
+        """
+        Get one line of the string representation.
+        """
+        return next(self.lines(index, 1), "")
+
+
+HIERARCHY_CACHE = "hierarchy_cache.pickle"
+# Increase when the pickled classes change so that old caches are rebuilt
+HIERARCHY_CACHE_VERSION = 2
+ENCODINGS = ["utf-8", "ascii"]
+
+def data_fingerprint(frames: list, store):
+    """
+    Computes a fingerprint of the frame data and the relation table. The data files are
+    identified by name, size and modification time, so no frame is read.
+    :param frames: List of frame names included in the hierarchies.
+    :param store: Frame store the hierarchies are built from.
+    :return: Hex digest string.
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps([HIERARCHY_CACHE_VERSION, all_relations, sorted(frames)]).encode())
+    if os.path.isdir(store.path):
+        entries = [entry for entry in os.scandir(store.path) if entry.name[-5:] == ".json" and not entry.name.startswith('.')]
+        files = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries)
+    else:
+        stat = os.stat(store.path)
+        files = [(os.path.basename(store.path), stat.st_size, stat.st_mtime_ns)]
+    digest.update(json.dumps(files).encode())
+    return digest.hexdigest()
+
+def load_cached_hierarchies(frames: list, store = None, cache_path: str = HIERARCHY_CACHE, fingerprint: str = None):
+    """
+    Loads the hierarchies from the cache file if it was built from the same data.
+    :param frames: List of frame names included in the hierarchies.
+    :param store: Frame store the hierarchies are built from. Defaults to frame_store.open_store().
+    :param cache_path: Path of the cache file.
+    :param fingerprint: data_fingerprint() of the frames and the store, if already computed.
+    :return: Dictionary mapping (frame_relation, reverse_order, encoding) to the root node, or None.
+    """
+    if store is None:
+        store = open_store()
+    if not cache_path or not os.path.exists(cache_path):
+        count("hierarchy_cache.misses")
+        return None
+    try:
+        with open(cache_path, 'rb') as fo:
+            cached = pickle.load(fo)
+    except Exception as e:
+        print(f"[Warning] Ignoring unreadable hierarchy cache {cache_path}: {e}")
+        count("hierarchy_cache.misses")
+        return None
+    if cached.get("fingerprint") != (fingerprint or data_fingerprint(frames, store)):
+        count("hierarchy_cache.misses")
+        return None
+    count("hierarchy_cache.hits")
+    return cached["hierarchies"]
+
+def save_hierarchies(frames: list, hierarchies: dict, store = None, cache_path: str = HIERARCHY_CACHE, fingerprint: str = None):
+    """
+    Saves the hierarchies to the cache file together with the fingerprint of the data.
+    :param frames: List of frame names included in the hierarchies.
+    :param hierarchies: Dictionary mapping (frame_relation, reverse_order, encoding) to the root node.
+    :param store: Frame store the hierarchies are built from. Defaults to frame_store.open_store().
+    :param cache_path: Path of the cache file.
+    :param fingerprint: data_fingerprint() of the data the hierarchies were built from. Compute it
+        before building, otherwise changes made to the data meanwhile go unnoticed.
+    """
+    if store is None:
+        store = open_store()
+    if fingerprint is None:
+        fingerprint = data_fingerprint(frames, store)
+    try:
+        with open(cache_path + ".tmp", 'wb') as fo:
+            pickle.dump({"fingerprint": fingerprint, "hierarchies": hierarchies}, fo, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError as e:
+        print(f"[Warning] Failed to save hierarchy cache {cache_path}: {e}")
+    return
+
+def load_hierarchies(frames: list, store = None, cache_path: str = HIERARCHY_CACHE):
+    """
+    Gets the hierarchies of all relations, in both directions and encodings. They are loaded
+    from the cache file if it was built from the same data, otherwise built and saved to it.
+    :param frames: List of frame names to include in the hierarchies.
+    :param store: Frame store to read frames from. Defaults to frame_store.open_store().
+    :param cache_path: Path of the cache file. None to disable caching.
+    :return: Dictionary mapping (frame_relation, reverse_order, encoding) to the root node.
+    """
+    if store is None:
+        store = open_store()
+    fingerprint = data_fingerprint(frames, store) if cache_path else None
+    hierarchies = load_cached_hierarchies(frames, store, cache_path, fingerprint)
+    if hierarchies is not None:
+        return hierarchies
+
+    graph = FrameGraph(frames, store)
+    hierarchies = {}
+    for frame_relation in all_relations:
+        for reverse_order in [False, True]:
+            for encoding in ENCODINGS:
+                hierarchies[(frame_relation, reverse_order, encoding)] = graph.hierarchy(frame_relation, reverse_order, encoding)
+    if cache_path:
+        save_hierarchies(frames, hierarchies, store, cache_path, fingerprint)
+    return hierarchies
 
 def save_hierarchy_to_file(root, filename):
     """
@@ -183,16 +913,24 @@ def save_hierarchy_to_file(root, filename):
         fo.write(str(root))
     print(f"Hierarchy has been saved to {filename}!")
 
-def analyze_all_relations(frames):
-    from frame_hierarchy_examiner import check_hierarchy
+def analyze_all_relations(frames, store=None):
+    from frame_hierarchy_examiner import validate_hierarchies, format_violation
+    graph = FrameGraph(frames, store)
+    hierarchies = {}
     for frame_relation in frame_relations.keys():
-        root = analyze_hierarchy(frames, frame_relation)
-        if check_hierarchy(root, frame_relation):
-            save_hierarchy_to_file(root, f"tmp_result_{frame_relation}.txt")
+        for reverse_order in [False, True]:
+            hierarchies[(frame_relation, reverse_order)] = analyze_hierarchy(frames, frame_relation, reverse_order, graph=graph)
+    violations = validate_hierarchies(frames, hierarchies, graph=graph)
+    for frame_relation in frame_relations.keys():
+        relation_violations = [violation for violation in violations if violation.relation == frame_relation]
+        if not relation_violations:
+            save_hierarchy_to_file(hierarchies[(frame_relation, False)], f"tmp_result_{frame_relation}.txt")
         else:
-            print("[Error] Hierarchy check failed!")
+            for violation in relation_violations:
+                print(format_violation(violation))
+            print(f"[Error] Hierarchy check failed with {len(relation_violations)} violations!")
         # save_hierarchy_to_file(root, f"tmp_result_{frame_relation}.txt")
-    return
+    return violations
 
     
 
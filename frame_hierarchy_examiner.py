@@ -1,13 +1,19 @@
-from frame_hierarchy_analyzer import analyze_hierarchy, frame_relations
+from frame_hierarchy_analyzer import frame_relations, FrameGraph
+from frame_store import open_store
+from collections import namedtuple, Counter
 import os
-import json
 
-def check_node(node, father_node, frame_relation, reverse_order=False):
+# A mismatch between a hierarchy and the relations recorded in the frames.
+# kind: "wrong_parent", "missing_child", "unexpected_child", "asymmetric", "duplicate_node" or "unknown_frame"
+Violation = namedtuple("Violation", ["relation", "reverse_order", "kind", "frame", "detail"])
+
+def check_node(node, father_node, frame_relation, reverse_order=False, store=None):
     """
     Checks if a node has correct father and child relations.
     """
-    with open(f"frame_json/{node.name}.json", 'r') as fo:
-        data_dict = json.load(fo)
+    if store is None:
+        store = open_store()
+    data_dict = store.get(node.name, ["fr_rel"])
     children = data_dict.get("fr_rel").get(frame_relations[frame_relation][1 if not reverse_order else 0])
     children = [child.strip() for child in children.split(', ')] if children else []
     fathers = data_dict.get("fr_rel").get(frame_relations[frame_relation][0 if not reverse_order else 1])
@@ -18,25 +24,129 @@ def check_node(node, father_node, frame_relation, reverse_order=False):
     return 0
 
 
-def check_hierarchy(node, frame_relation, reverse_order=False):
+def check_hierarchy(node, frame_relation, reverse_order=False, store=None):
     """
     Recursively check all the son nodes.
     """
     if node.next == {}:
         return True
+    if store is None:
+        store = open_store()
     for son_node in node.next.values():
-        if not check_node(son_node, node, frame_relation, reverse_order) \
-            or not check_hierarchy(son_node, frame_relation, reverse_order):
+        if not check_node(son_node, node, frame_relation, reverse_order, store) \
+            or not check_hierarchy(son_node, frame_relation, reverse_order, store):
             return False
     return True
 
 
+def validate_relations(graph: FrameGraph, frame_relation: str):
+    """
+    Checks that each relation is recorded in both frames, and that no frame is listed twice.
+    :param graph: FrameGraph of the frames.
+    :param frame_relation: The relation type to check.
+    :return: List of Violations.
+    """
+    violations = []
+    for reverse_order in [False, True]:
+        label = frame_relations[frame_relation][0 if not reverse_order else 1]
+        inverse_label = frame_relations[frame_relation][1 if not reverse_order else 0]
+        for name in graph.names.values():
+            related = graph.related(name, label)
+            for other, count in Counter(related).items():
+                if count > 1:
+                    violations.append(Violation(frame_relation, reverse_order, "duplicate_node", name, f'"{other}" is listed {count} times under "{label}"'))
+                if other in graph.nodes and name not in graph.related(other, inverse_label):
+                    violations.append(Violation(frame_relation, reverse_order, "asymmetric", name, f'"{other}" is listed under "{label}" but "{other}" does not list it under "{inverse_label}"'))
+    return violations
+
+
+def validate_hierarchy(root, graph: FrameGraph, frame_relation: str, reverse_order: bool = False):
+    """
+    Checks every node and every parent-child edge of a hierarchy against the relation table. The
+    children of a shared node are checked once.
+    :param root: Root node of the hierarchy.
+    :param graph: FrameGraph of the frames the hierarchy was built from.
+    :param frame_relation: The relation type of the hierarchy.
+    :param reverse_order: The direction of the hierarchy.
+    :return: List of Violations.
+    """
+    children_label = frame_relations[frame_relation][1 if not reverse_order else 0]
+    parents_label = frame_relations[frame_relation][0 if not reverse_order else 1]
+    root_name = f"[{children_label}]"
+    violations = []
+    nodes = {}
+    visited = set()
+    # nodes whose children were checked
+    checked = set()
+    stack = [root]
+    while stack:
+        father_node = stack.pop()
+        if father_node in visited:
+            continue
+        visited.add(father_node)
+        for node in father_node.next.values():
+            if nodes.setdefault(node.name, node) is not node:
+                violations.append(Violation(frame_relation, reverse_order, "duplicate_node", node.name, "appears as different nodes in the hierarchy"))
+            stack.append(node)
+            # every edge to a shared node is checked, not only the first one visited
+            if node.name not in graph.nodes:
+                violations.append(Violation(frame_relation, reverse_order, "unknown_frame", node.name, f'is listed by "{father_node.name}" but is not a frame'))
+                continue
+
+            fathers = graph.related(node.name, parents_label)
+            if father_node.name == root_name:
+                if fathers:
+                    violations.append(Violation(frame_relation, reverse_order, "wrong_parent", node.name, f'is at the top but lists {fathers} under "{parents_label}"'))
+            elif father_node.name not in fathers:
+                violations.append(Violation(frame_relation, reverse_order, "wrong_parent", node.name, f'is under "{father_node.name}" which is not listed under "{parents_label}"'))
+
+            if node in checked:
+                continue
+            checked.add(node)
+            children = set(graph.related(node.name, children_label))
+            for child in sorted(children - node.next.keys()):
+                violations.append(Violation(frame_relation, reverse_order, "missing_child", node.name, f'"{child}" is listed under "{children_label}" but is not a child'))
+            for child in sorted(node.next.keys() - children):
+                violations.append(Violation(frame_relation, reverse_order, "unexpected_child", node.name, f'"{child}" is a child but is not listed under "{children_label}"'))
+    return violations
+
+
+def validate_hierarchies(frames: list, hierarchies: dict = None, store = None, graph: FrameGraph = None):
+    """
+    Checks the hierarchies of all relations in both directions, and the symmetry of the relations,
+    reporting every violation instead of stopping at the first one.
+    :param frames: List of frame names the hierarchies are built from.
+    :param hierarchies: Dictionary mapping (frame_relation, reverse_order) to the root node. Built from the graph if not given.
+    :param store: Frame store to read frames from. Defaults to frame_store.open_store().
+    :param graph: FrameGraph of the frames. Built from the store if not given.
+    :return: List of Violations.
+    """
+    if graph is None:
+        graph = FrameGraph(frames, store)
+    violations = []
+    for frame_relation in frame_relations:
+        violations += validate_relations(graph, frame_relation)
+        for reverse_order in [False, True]:
+            if hierarchies is not None and (frame_relation, reverse_order) in hierarchies:
+                root = hierarchies[(frame_relation, reverse_order)]
+            else:
+                root = graph.hierarchy(frame_relation, reverse_order)
+            violations += validate_hierarchy(root, graph, frame_relation, reverse_order)
+    return violations
+
+
+def format_violation(violation: Violation):
+    direction = frame_relations[violation.relation][1 if not violation.reverse_order else 0]
+    return f"[{violation.relation}: {direction}] {violation.kind}: \"{violation.frame}\" {violation.detail}"
+
+
 if __name__ == "__main__":
     frame_folder = "frame"
     frames = [file[:-4] for file in os.listdir(frame_folder) if file[-4:] == ".xml"]
-    frame_relation = "Inheritance"
-    root = analyze_hierarchy(frames, frame_relation)
-    if check_hierarchy(root, frame_relation):
+    violations = validate_hierarchies(frames)
+    if not violations:
         print(f"Successfully passed!")
     else:
-        print("Failed!")
\ No newline at end of file
+        for violation in violations:
+            print(format_violation(violation))
+        print(f"Failed! {len(violations)} violations: {dict(Counter(violation.kind for violation in violations))}")
\ No newline at end of file
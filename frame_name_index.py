@@ -0,0 +1,183 @@
+from bisect import bisect_left
+from collections import Counter
+from itertools import chain
+
+# Largest default edit distance of fuzzy matches: farther names are rarely the intended ones,
+# and each more edit lets many more names through the n-gram filter
+MAX_DISTANCE = 3
+
+
+def normalize(text: str):
+    """
+    Normalizes a frame name for matching: lower case, with spaces and hyphens as underscores.
+    """
+    return text.strip().lower().replace(' ', '_').replace('-', '_')
+
+def trigrams(key: str):
+    """
+    Get the set of trigrams of a normalized name, padded so that its start and end count too.
+    """
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def char_mask(key: str):
+    """
+    Get the set of characters of a name as a bit mask, characters with the same code modulo 64 sharing a bit.
+    """
+    mask = 0
+    for char in key:
+        mask |= 1 << (ord(char) & 63)
+    return mask
+
+def bigrams(key: str):
+    """
+    Get the set of bigrams of a normalized name, padded so that its start and end count too.
+    """
+    padded = f" {key} "
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+def edit_distance(a: str, b: str, max_distance: int = None):
+    """
+    Levenshtein distance between two strings, counting a swap of adjacent characters as one edit.
+    Only the cells within max_distance of the diagonal are computed.
+    :param max_distance: Stop as soon as the distance is known to be larger, and return max_distance + 1.
+    """
+    if max_distance is None:
+        max_distance = max(len(a), len(b))
+    limit = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return limit
+    previous2 = None
+    previous = [min(j, limit) for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [limit] * (len(b) + 1)
+        current[0] = min(i, limit)
+        start, end = max(1, i - max_distance), min(len(b), i + max_distance)
+        char = a[i - 1]
+        for j in range(start, end + 1):
+            cost = previous[j - 1] + (char != b[j - 1])
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            if i > 1 and j > 1 and char == b[j - 2] and a[i - 2] == b[j - 1] and previous2[j - 2] + 1 < cost:
+                cost = previous2[j - 2] + 1
+            current[j] = cost
+        if min(current[start - 1:end + 1]) > max_distance:
+            return limit
+        previous2, previous = previous, current
+    return min(previous[-1], limit)
+
+
+class FrameNameIndex(object):
+    """
+    Index of frame names for completion. Prefix matches are found by binary search over the
+    sorted names, fuzzy matches through the trigrams they share with the query.
+    """
+
+    def __init__(self, names: list):
+        """
+        :param names: Frame names, e.g. from frame_hierarchy_analyzer.get_frames().
+        """
+        self.names = sorted(set(names), key=lambda name: (normalize(name), name))
+        self.keys = [normalize(name) for name in self.names]
+        self._names = set(self.names)
+        # postings[trigram]: indexes of the names containing the trigram, same for bigrams
+        self.postings = {}
+        self.bigram_postings = {}
+        self.masks = [char_mask(key) for key in self.keys]
+        for i, key in enumerate(self.keys):
+            for trigram in trigrams(key):
+                self.postings.setdefault(trigram, []).append(i)
+            for bigram in bigrams(key):
+                self.bigram_postings.setdefault(bigram, []).append(i)
+        return
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self.names)
+
+    def prefix(self, text: str, limit: int = 10):
+        """
+        Finds the names starting with a text, ignoring case, shortest first.
+        :param text: Beginning of a frame name.
+        :param limit: Maximum number of names to return.
+        :return: List of frame names.
+        """
+        key = normalize(text)
+        if not key:
+            return []
+        start = bisect_left(self.keys, key)
+        end = bisect_left(self.keys, key + '\uffff', start)
+        matches = sorted(range(start, end), key=lambda i: (len(self.keys[i]), i))[:limit]
+        return [self.names[i] for i in matches]
+
+    def fuzzy(self, text: str, limit: int = 10, max_distance: int = None):
+        """
+        Finds the names closest to a text, which may be mistyped.
+        :param text: Frame name or part of it.
+        :param limit: Maximum number of names to return.
+        :param max_distance: Maximum edit distance. Defaults to a quarter of the text length, at least 2
+            and at most MAX_DISTANCE.
+        :return: List of frame names, closest first.
+        """
+        key = normalize(text)
+        if not key:
+            return []
+        if max_distance is None:
+            max_distance = min(MAX_DISTANCE, max(2, len(key) // 4))
+        # an edit changes at most 4 trigrams, or 3 bigrams (a swap of adjacent characters, counted as
+        # one edit, changes the most), so closer names share at least len(grams) - per_edit * max_distance
+        grams, postings, per_edit = trigrams(key), self.postings, 4
+        if len(grams) - per_edit * max_distance <= 0:
+            # short texts: the trigrams would let every name through, the bigrams fewer
+            grams, postings, per_edit = bigrams(key), self.bigram_postings, 3
+        shared = Counter(chain.from_iterable(postings.get(gram, ()) for gram in grams))
+        min_shared = len(grams) - per_edit * max_distance
+        if min_shared <= 0:
+            # very short texts: names sharing no bigram at all can still be close enough
+            shared = Counter({i: shared[i] for i in range(len(self.keys))})
+        candidates = sorted(
+            (-count, i) for i, count in shared.items()
+            if count >= min_shared and abs(len(self.keys[i]) - len(key)) <= max_distance
+        )
+        mask = char_mask(key)
+        scored = []
+        for count, i in candidates:
+            if -count < len(grams) - per_edit * max_distance:
+                # the bound is tighter once max_distance shrinks, and the candidates only share fewer
+                break
+            # each character found in only one of the names takes an edit of its own, and those missing
+            # from the longer name are not removed by the insertions making up the length difference
+            missing, extra = (mask & ~self.masks[i]).bit_count(), (self.masks[i] & ~mask).bit_count()
+            length_difference = len(self.keys[i]) - len(key)
+            if length_difference >= 0:
+                lower_bound = max(extra, length_difference + missing)
+            else:
+                lower_bound = max(missing, extra - length_difference)
+            if lower_bound > max_distance:
+                continue
+            distance = edit_distance(key, self.keys[i], max_distance)
+            if distance <= max_distance:
+                scored.append((distance, count, i))
+                if len(scored) >= limit:
+                    # later candidates share fewer n-grams, they need to be strictly closer to rank
+                    scored = sorted(scored)[:limit]
+                    max_distance = scored[-1][0] - 1
+                    if max_distance < 0:
+                        break
+        return [self.names[i] for _, _, i in sorted(scored)[:limit]]
+
+    def complete(self, text: str, limit: int = 5):
+        """
+        Get the completions of a text typed by the user: prefix matches first, then fuzzy matches.
+        :param text: Text typed so far.
+        :param limit: Maximum number of names to return.
+        :return: List of frame names.
+        """
+        completions = self.prefix(text, limit)
+        if len(completions) < limit:
+            completions += [name for name in self.fuzzy(text, limit) if name not in completions][:limit - len(completions)]
+        return completions
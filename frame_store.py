@@ -0,0 +1,196 @@
+import json
+import os
+import sqlite3
+import threading
+
+STORE_PATH = "frame_store.sqlite"
+JSON_FOLDER = "frame_json"
+# Records the signature of every source file converted by framenet_xml_parser, rewritten after each
+# run; hidden so that readers of the JSON folder skip it
+MANIFEST_NAME = ".manifest.json"
+
+# Fields of a frame JSON document, in the order written by framenet_xml_parser
+FIELDS = ["frame_name", "frame_def", "fe_def", "lexical", "examples", "fr_rel"]
+
+
+class JsonFrameStore(object):
+    """
+    Reads frames from the per-frame JSON files in a folder (one file per frame).
+    Documents are read at most once and kept in memory.
+    """
+
+    def __init__(self, json_folder_path: str = JSON_FOLDER):
+        """
+        :param json_folder_path: Folder of JSON files created by framenet_xml_parser.
+        """
+        self.path = json_folder_path
+        self._documents = {}
+        self._lock = threading.Lock()
+        return
+
+    def frames(self):
+        """
+        Get the list of frames in the store, named after their source files.
+        :return: List of frame names.
+        """
+        return sorted(file[:-5] for file in os.listdir(self.path) if file[-5:] == ".json" and not file.startswith('.'))
+
+    def __contains__(self, frame):
+        return os.path.exists(os.path.join(self.path, f"{frame}.json"))
+
+    def __len__(self):
+        return len(self.frames())
+
+    def _document(self, frame):
+        with self._lock:
+            if frame not in self._documents:
+                with open(os.path.join(self.path, f"{frame}.json"), 'r') as fo:
+                    self._documents[frame] = json.load(fo)
+            return self._documents[frame]
+
+    def get(self, frame: str, fields: list = None):
+        """
+        Get the data of one frame.
+        :param frame: Frame name.
+        :param fields: Fields to return. Defaults to all fields.
+        :return: Dictionary of the requested fields, or None if the frame does not exist.
+        """
+        if frame not in self:
+            return None
+        document = self._document(frame)
+        return {field: document.get(field) for field in (fields or FIELDS)}
+
+    def load(self, field: str, frames: list = None):
+        """
+        Get one field for many frames.
+        :param field: Field to load, e.g. "fr_rel".
+        :param frames: Frames to load. Defaults to all frames in the store.
+        :return: Dictionary mapping each frame to the value of the field.
+        """
+        assert field in FIELDS, f'''Please enter one of the fields: ['{"', '".join(FIELDS)}']'''
+        return {frame: self._document(frame).get(field) for frame in (frames if frames is not None else self.frames())}
+
+    def items(self, fields: list = None):
+        """
+        Iterate over all frames.
+        :param fields: Fields to return for each frame. Defaults to all fields.
+        :return: Iterator of (frame, data dictionary).
+        """
+        for frame in self.frames():
+            yield frame, self.get(frame, fields)
+
+    def close(self):
+        return
+
+
+class FrameStore(JsonFrameStore):
+    """
+    Reads frames from a single SQLite file holding every frame, one column per field.
+    Fields are only decoded when requested, and the file is memory-mapped by SQLite.
+    """
+
+    def __init__(self, store_path: str = STORE_PATH, mmap_size: int = 1 << 28):
+        """
+        :param store_path: Path of the store created by FrameStore.build.
+        :param mmap_size: Maximum number of bytes of the file SQLite maps into memory.
+        """
+        self.path = store_path
+        self._fields = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(f"file:{store_path}?mode=ro", uri=True, check_same_thread=False)
+        self._conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        self._frames = [row[0] for row in self._query("SELECT frame FROM frames ORDER BY frame")]
+        self._frame_set = set(self._frames)
+        return
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def frames(self):
+        return list(self._frames)
+
+    def __contains__(self, frame):
+        return frame in self._frame_set
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, frame: str, fields: list = None):
+        fields = fields or FIELDS
+        for field in fields:
+            assert field in FIELDS, f'''Please enter one of the fields: ['{"', '".join(FIELDS)}']'''
+        if frame not in self:
+            return None
+        if all(field in self._fields for field in fields):
+            return {field: self._fields[field][frame] for field in fields}
+        rows = self._query(f"SELECT {', '.join(fields)} FROM frames WHERE frame = ?", (frame,))
+        return {field: json.loads(value) for field, value in zip(fields, rows[0])}
+
+    def load(self, field: str, frames: list = None):
+        """
+        Get one field for many frames. The whole column is read in one query and kept in memory.
+        :param field: Field to load, e.g. "fr_rel".
+        :param frames: Frames to load. Defaults to all frames in the store.
+        :return: Dictionary mapping each frame to the value of the field.
+        """
+        assert field in FIELDS, f'''Please enter one of the fields: ['{"', '".join(FIELDS)}']'''
+        if field not in self._fields:
+            column = {frame: json.loads(value) for frame, value in self._query(f"SELECT frame, {field} FROM frames")}
+            with self._lock:
+                self._fields[field] = column
+        column = self._fields[field]
+        if frames is None:
+            return dict(column)
+        return {frame: column[frame] for frame in frames}
+
+    def items(self, fields: list = None):
+        fields = fields or FIELDS
+        for row in self._query(f"SELECT frame, {', '.join(fields)} FROM frames ORDER BY frame"):
+            yield row[0], {field: json.loads(value) for field, value in zip(fields, row[1:])}
+
+    def close(self):
+        self._conn.close()
+        return
+
+    @staticmethod
+    def build(json_folder_path: str = JSON_FOLDER, store_path: str = STORE_PATH):
+        """
+        Packs all the JSON files of a folder into a single store file. The store is written
+        to a temporary file first and then moved into place.
+        :param json_folder_path: Folder of JSON files created by framenet_xml_parser.
+        :param store_path: Path of the store to write.
+        :return: Number of frames written.
+        """
+        source = JsonFrameStore(json_folder_path)
+        tmp_path = store_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        conn.execute(f"CREATE TABLE frames (frame TEXT PRIMARY KEY, {', '.join(f'{field} TEXT' for field in FIELDS)})")
+        count = 0
+        for frame, data in source.items():
+            conn.execute(
+                f"INSERT INTO frames VALUES ({', '.join('?' * (len(FIELDS) + 1))})",
+                [frame] + [json.dumps(data[field]) for field in FIELDS],
+            )
+            count += 1
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, store_path)
+        return count
+
+
+def open_store(store_path: str = STORE_PATH, json_folder_path: str = JSON_FOLDER):
+    """
+    Opens the packed store if it exists, otherwise reads the per-frame JSON files. The JSON files
+    are also read if they were converted again after the store was packed, as the store is then stale.
+    :param store_path: Path of the packed store.
+    :param json_folder_path: Folder of JSON files used when there is no up-to-date packed store.
+    :return: FrameStore or JsonFrameStore.
+    """
+    if store_path and os.path.exists(store_path):
+        manifest_path = os.path.join(json_folder_path, MANIFEST_NAME)
+        if not os.path.exists(manifest_path) or os.path.getmtime(manifest_path) <= os.path.getmtime(store_path):
+            return FrameStore(store_path)
+    return JsonFrameStore(json_folder_path)
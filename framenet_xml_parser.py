@@ -1,27 +1,79 @@
-from bs4 import BeautifulSoup
+from lxml import etree
 import re
 import json
 import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from frame_store import FrameStore, STORE_PATH, MANIFEST_NAME
+from instrumentation import span, count
 
-def get_fr_name(name):
-    with open(name, 'r') as f:
-        data = f.read()
-    Bs_data = BeautifulSoup(data, "xml")
-    frame_name=Bs_data.find('frame').get('name')
+TAG_PATTERN = re.compile(r'<[^>]+>')
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+EXAMPLE_PARSER = etree.XMLParser(recover=True)
+
+def local_name(elem):
+    return etree.QName(elem).localname
+
+def escape_text(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def text_node(text):
+    # whitespace-only strings were collapsed to a single newline or space
+    if text and not text.strip(ASCII_SPACES):
+        return '\n' if '\n' in text else ' '
+    return escape_text(text or "")
+
+def unescape_brackets(text):
+    return text.replace('&lt;','<').replace('&gt;','>')
+
+def quote_attribute(value):
+    value = escape_text(value)
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return '"' + value.replace('"', '&quot;') + '"'
+
+def serialize(elem):
+    """
+    Serializes an element the way the former BeautifulSoup-based parser printed tags,
+    so that the string processing below yields the same JSON output.
+    :param elem: lxml element to serialize.
+    :return: Markup string of the element without its tail.
+    """
+    if isinstance(elem, etree._Comment):
+        return f"<!--{elem.text or ''}-->"
+    if isinstance(elem, etree._ProcessingInstruction):
+        return f"<?{elem.target} {elem.text or ''}?>"
+    name = local_name(elem)
+    if elem.prefix:
+        name = f"{elem.prefix}:{name}"
+    prefixes = {uri: prefix for prefix, uri in elem.nsmap.items() if prefix}
+    attrs = ""
+    for key, value in elem.attrib.items():
+        qname = etree.QName(key)
+        if qname.namespace in prefixes:
+            key = f"{prefixes[qname.namespace]}:{qname.localname}"
+        attrs += f" {key}={quote_attribute(value)}"
+    if not elem.text and len(elem) == 0:
+        return f"<{name}{attrs}/>"
+    content = text_node(elem.text)
+    for child in elem:
+        content += serialize(child) + text_node(child.tail)
+    return f"<{name}{attrs}>{content}</{name}>"
+
+def get_fr_name(frame):
+    frame_name=frame.get('name')
     if len(frame_name)!=0:
         frame_name=frame_name.strip()
         return frame_name
     else:
         return "no frame name"
 
-def get_fr_def(name):
-    with open(name, 'r') as f:
-        data = f.read()
-    Bs_data = BeautifulSoup(data, "xml")
-    b_unique = Bs_data.find_all('definition')
-    if len(b_unique)!=0:
-        fr_def=str(b_unique[0]).replace('&lt;','<').replace('&gt;','>')
+def get_fr_def(definition):
+    if definition is not None:
+        fr_def=unescape_brackets(serialize(definition))
         min_no=0
         expos=fr_def.find('<ex>')
         if expos==-1:
@@ -34,45 +86,34 @@ def get_fr_def(name):
         else:
             min_no=min(expos,defpos)
         fr_def=fr_def[fr_def.find('<def-root>')+10:min_no].replace('\n',' ').strip()
-        fr_def=re.compile(r'<[^>]+>').sub('', fr_def).strip()
+        fr_def=TAG_PATTERN.sub('', fr_def).strip()
         return fr_def
     else:
         return "no frame definition"
 
-def get_fe_def(name):
-    with open(name, 'r') as f:
-        data = f.read()
-    Bs_data = BeautifulSoup(data, "xml")
-    
-    fe_unique = Bs_data.find_all('FE')
-    if len(fe_unique)!=0:
-        for i in range(len(fe_unique)):
-            name=fe_unique[i].get('name').replace("-"," ").replace("_"," ").strip()
-            value=fe_unique[i].find('definition')
-            value=str(value).replace('&lt;','<').replace('&gt;','>')
-            marker=value.find('<ex>')
-            if marker==-1:
-                marker=214748
-            value=value[:min(marker,len(value))].replace('\n',' ')
-            value=re.compile(r'<[^>]+>').sub('', value).strip()
-            yield name,value
-    else:
-        return "no frame element found","no frame element definition found"
+def find_definition(elem):
+    for child in elem.iter():
+        if child is not elem and isinstance(child.tag, str) and local_name(child) == 'definition':
+            return child
+    return None
 
-def get_lex_udef(name):
-    with open(name, 'r') as f:
-        data = f.read()
-    Bs_data = BeautifulSoup(data, "xml")
-    
-    le_unique = Bs_data.find_all('lexUnit')
-    if len(le_unique)!=0:
-        for i in le_unique:
-            name=str(i.get('name')).replace("-"," ").replace("_"," ").strip()
-            value=str(i.find("definition")).replace('&lt;','<').replace('&gt;','>').replace('\n',' ')
-            value=re.compile(r'<[^>]+>').sub('', value).strip()
-            yield name,value
-    else:
-        return "no lex unit","no lex unit def"
+def get_fe_def(fe):
+    name=fe.get('name').replace("-"," ").replace("_"," ").strip()
+    definition=find_definition(fe)
+    value=unescape_brackets(serialize(definition) if definition is not None else "None")
+    marker=value.find('<ex>')
+    if marker==-1:
+        marker=214748
+    value=value[:min(marker,len(value))].replace('\n',' ')
+    value=TAG_PATTERN.sub('', value).strip()
+    return name,value
+
+def get_lex_udef(lex_unit):
+    name=str(lex_unit.get('name')).replace("-"," ").replace("_"," ").strip()
+    definition=find_definition(lex_unit)
+    value=unescape_brackets(serialize(definition) if definition is not None else "None").replace('\n',' ')
+    value=TAG_PATTERN.sub('', value).strip()
+    return name,value
     
 def whole_tag(text,tag,at="name="): #inner content,remaining part, attribute data
     value=text[text.find('>',text.find(f"<{tag}"))+1:text.find(f"</{tag}>")]
@@ -82,116 +123,269 @@ def whole_tag(text,tag,at="name="): #inner content,remaining part, attribute dat
         att_name=""
     return value.strip(),text[text.find(f"</{tag}>")+len(tag)+3:].strip(),att_name.strip()
 
-def get_fr_ex(name):
-    with open(name, 'r') as f:
-        data = f.read()
-    Bs_data = BeautifulSoup(data, "xml")
-    Bs_data=str(Bs_data).replace('&lt;','<').replace('&gt;','>')
-    Bs_data = BeautifulSoup(Bs_data, "xml")
-
-    fe_unique=Bs_data.find_all('ex')
-    if len(fe_unique)!=-1:
-        for i in fe_unique:
-            value2=str(i).replace('&lt;','<').replace('&gt;','>').replace('\n',' ')
-            example=re.compile(r'<[^>]+>').sub('', value2[4:-5]).strip()
-            yield example
-            if value2.find('<t>')!=-1:
-                frame_rep=value2[value2.find('<t>')+3:value2.find('</t>')].strip()
-                yield frame_rep,f"the lexical unit of {get_fr_name(name)}"
-            temp=value2
-            for j in range(value2.count('<fex')):
-                v,temp,att=whole_tag(temp,'fex')
-                fele=att.replace('&lt;','<').replace('&gt;','>').replace('\n',' ')
-                yield v,fele
-    else: 
-        return "no example found"
+def get_fr_ex(definition, frame_name):
+    """
+    Yields the examples embedded in a definition, each followed by its
+    (target, lexical unit) and (annotated text, frame element) pairs.
+    :param definition: lxml element of a <definition> tag.
+    :param frame_name: Name of the frame the definition belongs to.
+    """
+    markup = unescape_brackets(serialize(definition))
+    tree = etree.fromstring(markup, EXAMPLE_PARSER)
+    if tree is None:
+        return
+    for i in tree.iter('ex'):
+        value2=unescape_brackets(serialize(i)).replace('\n',' ')
+        example=TAG_PATTERN.sub('', value2[4:-5]).strip()
+        yield example
+        if value2.find('<t>')!=-1:
+            frame_rep=value2[value2.find('<t>')+3:value2.find('</t>')].strip()
+            yield frame_rep,f"the lexical unit of {frame_name}"
+        temp=value2
+        for j in range(value2.count('<fex')):
+            v,temp,att=whole_tag(temp,'fex')
+            fele=unescape_brackets(att).replace('\n',' ')
+            yield v,fele
     
-def get_fr_rel(name):
-    with open(name, 'r') as f:
-        data = f.read()
-    Bs_data = BeautifulSoup(data, "xml")
-    le_unique = Bs_data.find_all('frameRelation')
-    joint=" ".join(str(i) for i in le_unique)
-    if joint.find('<relatedFrame')!=-1:
-        for i in le_unique:
-            if len(i.find_all('relatedFrame'))>0:
-                _,_,fr_type=whole_tag(str(i),"frameRelation","type=")
-                fr_type=fr_type.replace("-"," ").replace("_"," ").strip()
-                relation=", ".join(re.compile(r'<[^>]+>').sub('', str(j)).strip() for j in i.find_all('relatedFrame'))
-                relation=relation.strip()
-                yield fr_type,relation
-    else:
-        return "no related frame type","no related frame name"
+def get_fr_rel(frame_relation):
+    related_frames=[child for child in frame_relation if isinstance(child.tag, str) and local_name(child) == 'relatedFrame']
+    if not related_frames:
+        return None
+    _,_,fr_type=whole_tag(serialize(frame_relation),"frameRelation","type=")
+    fr_type=fr_type.replace("-"," ").replace("_"," ").strip()
+    relation=", ".join(TAG_PATTERN.sub('', serialize(j)).strip() for j in related_frames)
+    relation=relation.strip()
+    return fr_type,relation
 
 def xml_parser(name):
+    """
+    Converts a FrameNet frame XML file into a dictionary in a single streaming pass.
+    :param name: Path to the frame XML file.
+    :return: Dictionary with frame name, definitions, lexical units, examples and relations.
+    """
     out=dict()
-    
+    frame_name=None
+    frame_def=None
+    fe_dict=dict()
+    le_dict=dict()
+    frel_dict=dict()
+    examples=[]
+
+    for event, elem in etree.iterparse(name, events=("start", "end"), recover=True):
+        if not isinstance(elem.tag, str):
+            continue
+        tag=local_name(elem)
+        if event=="start":
+            if tag=='frame':
+                frame_name=get_fr_name(elem)
+            continue
+        if tag=='definition':
+            #frame def is the first definition in the document
+            if frame_def is None:
+                frame_def=get_fr_def(elem)
+            examples.extend(get_fr_ex(elem, frame_name))
+        elif tag=='FE':
+            fe_dict.update([get_fe_def(elem)])
+        elif tag=='lexUnit':
+            le_dict.update([get_lex_udef(elem)])
+        elif tag=='frameRelation':
+            relation=get_fr_rel(elem)
+            if relation:
+                frel_dict.update([relation])
+        parent=elem.getparent()
+        if parent is not None and parent.getparent() is None:
+            elem.clear()
+
+    if frame_name is None:
+        raise ValueError(f"no <frame> element found in {name}")
+
     #frame name
-    out['frame_name']=get_fr_name(name)
+    out['frame_name']=frame_name
     
     #frame def
-    out['frame_def']=get_fr_def(name)
+    out['frame_def']=frame_def if frame_def is not None else get_fr_def(None)
     
     #frame element desc
-    fe_dict=dict()
-    for i in get_fe_def(name):
-        fe_dict[i[0]]=i[1]
     out['fe_def']=fe_dict
     
     #frame lexical unit & def
-    le_dict=dict()
-    for i in get_lex_udef(name):
-        le_dict[i[0]]=i[1]
     out['lexical']=le_dict
     
     #frame examples
-    if get_fr_ex(name)=="no example found":
-        out['examples']="no example found"
-    else:
-        ex=""
-        fe_dict_in=dict()
-        fe_dict_out=dict()
-        for i in get_fr_ex(name):
-            if type(i)==type("asd") and len(fe_dict_in)>0:
-                fe_dict_out[ex]=fe_dict_in
-            if type(i)==type("asd"):
-                ex=i
-                fe_dict_in=dict()
-            elif type(i)==type(('a','b','v')):
-                fe_dict_in[i[0]]=i[1]
-            else:
-                out['examples']="no example/error"
-                break
-        out['examples']=fe_dict_out
+    ex=""
+    fe_dict_in=dict()
+    fe_dict_out=dict()
+    for i in examples:
+        if type(i)==type("asd") and len(fe_dict_in)>0:
+            fe_dict_out[ex]=fe_dict_in
+        if type(i)==type("asd"):
+            ex=i
+            fe_dict_in=dict()
+        elif type(i)==type(('a','b','v')):
+            fe_dict_in[i[0]]=i[1]
+    out['examples']=fe_dict_out
     
     #frame relation
-    frel_dict=dict()
-    for i in get_fr_rel(name):
-        frel_dict[i[0]]=i[1]
     out['fr_rel']=frel_dict
     
     return out
 
 def xml_to_json(input_path, output_path):
-    with open(output_path, 'w') as fo:
-        json.dump(xml_parser(input_path), fo, indent=4)
+    data = xml_parser(input_path)
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, 'w') as fo:
+        json.dump(data, fo, indent=4)
+    os.replace(tmp_path, output_path)
+    return
+
+def file_signature(path, with_hash=True):
+    """
+    Gets the signature of a source file used to detect changes between runs.
+    :param path: Path to the file.
+    :param with_hash: Whether to include the SHA-1 digest of the file content.
+    :return: Dictionary with mtime, size and (optionally) sha1.
+    """
+    stat = os.stat(path)
+    signature = {"mtime": stat.st_mtime, "size": stat.st_size}
+    if with_hash:
+        with open(path, 'rb') as fo:
+            signature["sha1"] = hashlib.sha1(fo.read()).hexdigest()
+    return signature
+
+def load_manifest(json_folder_path):
+    manifest_path = os.path.join(json_folder_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as fo:
+            return json.load(fo)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(json_folder_path, manifest):
+    manifest_path = os.path.join(json_folder_path, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", 'w') as fo:
+        json.dump(manifest, fo, indent=4, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
     return
 
-def parse(xml_folder_path, json_folder_path):
+def is_unchanged(xml_path, json_path, recorded):
+    """
+    Checks a source file against its manifest record. The hash is only computed
+    when mtime or size differ from the record.
+    :return: (unchanged, signature) where signature is the up-to-date record.
+    """
+    if not recorded or not os.path.exists(json_path):
+        return False, None
+    signature = file_signature(xml_path, with_hash=False)
+    if signature["mtime"] == recorded.get("mtime") and signature["size"] == recorded.get("size"):
+        return True, recorded
+    signature = file_signature(xml_path)
+    return signature["sha1"] == recorded.get("sha1"), signature
+
+def convert_file(paths):
+    """
+    Converts one XML file, catching errors so that a single bad file does not abort the batch.
+    :param paths: Tuple of (xml path, json path).
+    :return: Tuple of (xml path, signature, error message or None).
+    """
+    xml_path, json_path = paths
+    try:
+        signature = file_signature(xml_path)
+        xml_to_json(xml_path, json_path)
+        return xml_path, signature, None
+    except Exception as e:
+        return xml_path, None, f"{type(e).__name__}: {e}"
+
+def parse(xml_folder_path, json_folder_path, workers=1, incremental=True, store_path=None):
+    """
+    Converts all the .xml files in a folder to .json files.
+    :param xml_folder_path: Folder of FrameNet frame XML files.
+    :param json_folder_path: Folder to write the JSON files to.
+    :param workers: Number of processes used for conversion. Defaults to 1 (no subprocesses).
+    :param incremental: Skip files unchanged since the last run according to the manifest.
+        In any case, JSON files of frames deleted from the XML folder or failing to convert are removed.
+    :param store_path: If given, also pack the JSON files into a single frame store at this path.
+    :return: Dictionary mapping each failed file name to its error message.
+    """
     if not os.path.exists(json_folder_path):
         os.makedirs(json_folder_path)
     file_names = [file for file in os.listdir(xml_folder_path) if file[-4:] == ".xml"]
-    progress_bar = tqdm(total=len(file_names), desc="Parsing")
+    manifest = load_manifest(json_folder_path) if incremental else {}
+    new_manifest = {}
+
+    # skip unchanged files
+    tasks = []
     for file in file_names:
-        xml_to_json(f"{xml_folder_path}/{file}", f"{json_folder_path}/{file.replace('.xml', '.json')}")
-        progress_bar.update(1)
+        xml_path = f"{xml_folder_path}/{file}"
+        json_path = f"{json_folder_path}/{file.replace('.xml', '.json')}"
+        unchanged, signature = is_unchanged(xml_path, json_path, manifest.get(file)) if incremental else (False, None)
+        if unchanged:
+            new_manifest[file] = signature
+        else:
+            tasks.append((xml_path, json_path))
+
+    # remove frames deleted from the source folder, whether or not they are in the manifest
+    sources = set(file_names)
+    removed = [file for file in os.listdir(json_folder_path)
+               if file[-5:] == ".json" and not file.startswith('.') and file[:-5] + ".xml" not in sources]
+    for file in removed:
+        os.remove(f"{json_folder_path}/{file}")
+
+    failures = {}
+    with span("parse", profile=workers <= 1, files=len(tasks), workers=workers):
+        progress_bar = tqdm(total=len(tasks), desc="Parsing")
+        if workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(convert_file, tasks, chunksize=max(1, len(tasks) // (workers * 8)))
+                for xml_path, signature, error in results:
+                    file = os.path.basename(xml_path)
+                    if error:
+                        failures[file] = error
+                    else:
+                        new_manifest[file] = signature
+                    progress_bar.update(1)
+        else:
+            for task in tasks:
+                xml_path, signature, error = convert_file(task)
+                file = os.path.basename(xml_path)
+                if error:
+                    failures[file] = error
+                else:
+                    new_manifest[file] = signature
+                progress_bar.update(1)
     progress_bar.close()
-    print("Finished")
-    return
+    # the JSON of an earlier version of a failed file would be read as the current frame
+    for file in failures:
+        json_path = f"{json_folder_path}/{file.replace('.xml', '.json')}"
+        for path in [json_path, json_path + ".tmp"]:
+            if os.path.exists(path):
+                os.remove(path)
+    if tasks or removed or new_manifest != manifest:
+        # left as is otherwise, so that a frame store packed since then is still up to date
+        save_manifest(json_folder_path, new_manifest)
+    count("parse.converted", len(tasks) - len(failures))
+    count("parse.failed", len(failures))
+
+    for file, error in sorted(failures.items()):
+        print(f"[Error] Failed to parse {file}: {error}")
+    print(f"Finished: {len(tasks) - len(failures)} converted, {len(file_names) - len(tasks)} unchanged, "
+          f"{len(removed)} removed, {len(failures)} failed")
+    if store_path:
+        with span("store_build"):
+            packed = FrameStore.build(json_folder_path, store_path)
+        print(f"Packed {packed} frames into {store_path}")
+    return failures
 
 
 if __name__=="__main__":
-    xml_folder_path = "frame"
-    json_folder_path = "frame_json"
-    parse(xml_folder_path, json_folder_path)
+    import argparse
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--xml-folder', type=str, default='frame', help='Folder of FrameNet XML files')
+    parser.add_argument('--json-folder', type=str, default='frame_json', help='Folder to write JSON files to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of conversion processes')
+    parser.add_argument('--full', action='store_true', help='Convert every file, ignoring the manifest')
+    parser.add_argument('--store', type=str, default=None, help=f'Also pack all frames into a single store file, e.g. {STORE_PATH}')
+    args = parser.parse_args()
+    parse(args.xml_folder, args.json_folder, workers=args.workers, incremental=not args.full, store_path=args.store)
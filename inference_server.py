@@ -0,0 +1,379 @@
+import errno
+import http.client
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from models import GenerationStream, BACKENDS
+from instrumentation import metrics, span, count, observe, snapshot
+
+# Default address of the server: a Unix socket in the work directory
+DEFAULT_ADDRESS = "frame_blender.sock"
+
+
+def parse_address(address: str):
+    """
+    Parses a server address: "http://host:port" for localhost HTTP, otherwise the path of a Unix socket.
+    :return: ("tcp", (host, port)) or ("unix", path).
+    """
+    if address.startswith("http://"):
+        host, _, port = address[len("http://"):].rstrip('/').rpartition(':')
+        return "tcp", (host or "127.0.0.1", int(port))
+    return "unix", address
+
+
+class Job(object):
+    def __init__(self, request_id, prompt, frames, use_cache):
+        self.request_id = request_id
+        self.prompt = prompt
+        self.frames = frames
+        self.use_cache = use_cache
+        # ("text", piece), ("stats", dict) or ("error", message), then None at the end
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
+        self.submit_time = time.perf_counter()
+        return
+
+
+class InferenceServer(object):
+    """
+    Generates the responses of the requests of all clients one at a time, in the order they arrive,
+    with the models and the index loaded once.
+    """
+
+    def __init__(self, index, response_cache=None):
+        """
+        :param index: Index from rag.get_index(), after rag.load_models().
+        :param response_cache: ResponseCache shared by the clients, or None to always generate.
+        """
+        self.index = index
+        self.response_cache = response_cache
+        self.jobs = queue.Queue()
+        self.running = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+        return
+
+    def submit(self, prompt, frames=None, use_cache=True):
+        """
+        Queues a generation request.
+        :return: Job, whose messages are filled as the response is generated.
+        """
+        with self._lock:
+            job = Job(next(self._ids), prompt, frames, use_cache)
+            self._pending[job.request_id] = job
+        self.jobs.put(job)
+        return job
+
+    def cancel(self, request_id):
+        """
+        Cancels a queued request, or stops its generation if it is running.
+        :return: Whether the request was queued or running.
+        """
+        with self._lock:
+            job = self._pending.get(request_id)
+        if job is None:
+            return False
+        # stops the generation of this request only, after the current token
+        job.cancelled.set()
+        count("server.cancelled")
+        return True
+
+    def status(self):
+        return {"queued": self.jobs.qsize(), "running": self.running is not None}
+
+    def work(self):
+        from rag import get_query_engine, stream_response
+        while True:
+            job = self.jobs.get()
+            if not job.cancelled.is_set():
+                self.running = job
+                observe("server.queue_wait", time.perf_counter() - job.submit_time)
+                try:
+                    with span("request", request_id=job.request_id, frames=job.frames):
+                        query_engine = get_query_engine(streaming=True, frames=job.frames, index=self.index)
+                        stream = stream_response(query_engine, job.prompt, self.response_cache if job.use_cache else None, job.cancelled)
+                        for piece in stream:
+                            if job.cancelled.is_set():
+                                break
+                            job.messages.put(("text", piece))
+                        stream.close()
+                    job.messages.put(("stats", stream.stats()))
+                except Exception as e:
+                    count("server.errors")
+                    job.messages.put(("error", f"{type(e).__name__}: {e}"))
+                self.running = None
+            with self._lock:
+                del self._pending[job.request_id]
+            job.messages.put(None)
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """
+    GET /status: {"queued": ..., "running": ...}
+    GET /metrics: instrumentation.snapshot() of the server
+    POST /generate {"prompt": ..., "frames": [...], "use_cache": true}: the response as lines of JSON,
+        {"request_id": ..., "position": ...} first, then {"text": ...} pieces and {"stats": ...} or {"error": ...}
+    POST /cancel {"request_id": ...}: {"cancelled": true/false}
+    """
+
+    def log_message(self, format, *args):
+        return
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.send_json(self.server.inference.status())
+        elif self.path == "/metrics":
+            self.send_json(snapshot())
+        else:
+            self.send_json({"error": f"Unknown path: {self.path}"}, 404)
+        return
+
+    def do_POST(self):
+        inference = self.server.inference
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError as e:
+            self.send_json({"error": f"Invalid JSON: {e}"}, 400)
+            return
+        if self.path == "/cancel":
+            self.send_json({"cancelled": inference.cancel(request.get("request_id"))})
+        elif self.path != "/generate":
+            self.send_json({"error": f"Unknown path: {self.path}"}, 404)
+        elif not isinstance(request.get("prompt"), str):
+            self.send_json({"error": "Missing prompt"}, 400)
+        else:
+            self.generate(inference, request)
+        return
+
+    def generate(self, inference, request):
+        position = inference.jobs.qsize() + (inference.running is not None)
+        job = inference.submit(request["prompt"], request.get("frames"), request.get("use_cache", True))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            self.write_line({"request_id": job.request_id, "position": position})
+            while True:
+                message = job.messages.get()
+                if message is None:
+                    break
+                self.write_line({message[0]: message[1]})
+        except (BrokenPipeError, ConnectionResetError):
+            # the client is gone, its response is not needed anymore
+            inference.cancel(job.request_id)
+        return
+
+    def write_line(self, data):
+        self.wfile.write((json.dumps(data) + "\n").encode())
+        self.wfile.flush()
+        return
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def is_listening(socket_path):
+    """
+    Whether a server accepts connections on a Unix socket.
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+def make_server(address, inference):
+    """
+    Creates the HTTP server of an InferenceServer, listening on a Unix socket or a localhost port.
+    A socket file left by a server that did not stop cleanly is replaced.
+    :param address: See parse_address().
+    :raises OSError: EADDRINUSE if a server already listens on the socket, or the path is not a socket.
+    """
+    kind, location = parse_address(address)
+    if kind == "unix":
+        if os.path.exists(location):
+            if not stat.S_ISSOCK(os.stat(location).st_mode) or is_listening(location):
+                raise OSError(errno.EADDRINUSE, "Address already in use", location)
+            os.remove(location)
+        server = ThreadingUnixHTTPServer(location, InferenceHandler)
+    else:
+        server = ThreadingHTTPServer(location, InferenceHandler)
+    server.inference = inference
+    return server
+
+def serve(address=DEFAULT_ADDRESS, use_cache=True, dtype="float32", backend=None, threads=None, metrics_log=None):
+    """
+    Loads the models and the index, then answers the requests of the clients until interrupted.
+    :param address: See parse_address().
+    :param use_cache: Whether responses are cached in the ResponseCache of the work directory.
+    :param dtype: Type of the stored embeddings, see rag.get_index().
+    :param backend: Backend of the LLM, see rag.load_models().
+    :param threads: Number of CPU threads of the CPU backends.
+    :param metrics_log: JSONL file to append the measurements to, see instrumentation.Metrics.open_log().
+        A snapshot of the totals is appended when the server stops.
+    """
+    from rag import load_models, get_index
+    if metrics_log:
+        metrics.open_log(metrics_log)
+    from response_cache import ResponseCache
+    load_models(backend, threads)
+    index = get_index(dtype=dtype)
+    server = make_server(address, InferenceServer(index, ResponseCache() if use_cache else None))
+    print(f"Serving on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        kind, location = parse_address(address)
+        if kind == "unix" and os.path.exists(location):
+            os.remove(location)
+        if metrics_log:
+            metrics.close_log()
+            metrics.dump(metrics_log)
+    return
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+        return
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+        return
+
+
+class RemoteQueryEngine(object):
+    """
+    Client of an inference server, answering prompts like the query engine of rag.get_query_engine()
+    without loading any model.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, frames=None, timeout=None):
+        """
+        :param address: Address the server listens on, see parse_address().
+        :param frames: Only retrieve the chunks of these frames. Defaults to all frames.
+        :param timeout: Timeout of the connection in seconds, None to wait for the queued requests.
+        """
+        self.address = address
+        self.frames = frames
+        self.timeout = timeout
+        self._requests = set()
+        return
+
+    def _request(self, method, path, body=None):
+        kind, location = parse_address(self.address)
+        if kind == "unix":
+            connection = UnixHTTPConnection(location, self.timeout)
+        else:
+            connection = http.client.HTTPConnection(*location, timeout=self.timeout)
+        data = json.dumps(body).encode() if body is not None else None
+        connection.request(method, path, data, {"Content-Type": "application/json"} if data else {})
+        return connection.getresponse()
+
+    def status(self):
+        """
+        Get the number of queued requests and whether one is running. Raises OSError if the server is not running.
+        """
+        return json.load(self._request("GET", "/status"))
+
+    def metrics(self):
+        """
+        Get the measurements of the server, see instrumentation.snapshot().
+        """
+        return json.load(self._request("GET", "/metrics"))
+
+    def stream(self, prompt, use_cache=True):
+        """
+        Generates the response to a prompt piece by piece.
+        :param use_cache: Whether the server may reuse the response to an identical query.
+        :return: GenerationStream of the response text, measured from the time the request is sent.
+        """
+        stats = {}
+        count_tokens = lambda text: stats.get("tokens") or len(text.split())
+        return GenerationStream(self._pieces(prompt, use_cache, stats), count_tokens)
+
+    def _pieces(self, prompt, use_cache, stats):
+        response = self._request("POST", "/generate", {"prompt": prompt, "frames": self.frames, "use_cache": use_cache})
+        if response.status != 200:
+            raise RuntimeError(json.load(response).get("error"))
+        request_id = None
+        try:
+            for line in response:
+                message = json.loads(line)
+                if "request_id" in message:
+                    request_id = message["request_id"]
+                    self._requests.add(request_id)
+                elif "text" in message:
+                    yield message["text"]
+                elif "stats" in message:
+                    stats.update(message["stats"])
+                elif "error" in message:
+                    raise RuntimeError(message["error"])
+        finally:
+            self._requests.discard(request_id)
+            response.close()
+        return
+
+    def query(self, prompt, use_cache=True):
+        """
+        Get the whole response to a prompt.
+        :param use_cache: Whether the server may reuse the response to an identical query.
+        """
+        return "".join(self.stream(prompt, use_cache))
+
+    def cancel(self):
+        """
+        Cancels the requests of this client that are queued or running.
+        """
+        for request_id in list(self._requests):
+            self._request("POST", "/cancel", {"request_id": request_id}).read()
+        return
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Keeps the models and the index loaded for frame_blender and rag clients")
+    parser.add_argument('--address', type=str, default=DEFAULT_ADDRESS, help='Path of the Unix socket, or http://127.0.0.1:PORT')
+    parser.add_argument('--no-cache', action='store_true', help='Generate a new response to each request')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'], help='Type of the stored embeddings')
+    parser.add_argument('--backend', type=str, default=None, choices=BACKENDS, help='Where and how the LLM runs. Defaults to "cuda" if a GPU is available, "cpu-int8" otherwise')
+    parser.add_argument('--threads', type=int, default=None, help='Number of CPU threads of the CPU backends')
+    parser.add_argument('--metrics', type=str, default=None, help='JSONL file to append the timings, token counts and cache hits to')
+    parser.add_argument('--profile', type=str, default=None, help='Folder to save cProfile stats of the hot sections to')
+    parser.add_argument('--trace-memory', action='store_true', help='With --profile, also record the peak memory of the hot sections')
+    args = parser.parse_args()
+    if args.profile:
+        metrics.enable_profiling(args.profile, args.trace_memory)
+    serve(args.address, not args.no_cache, args.dtype, args.backend, args.threads, args.metrics)
@@ -0,0 +1,272 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Stat(object):
+    """
+    Count, total, minimum, maximum and last value of a series of measurements.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        return
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.last = value
+        return
+
+    def as_dict(self):
+        return {"count": self.count, "total": self.total, "mean": self.total / self.count if self.count else 0.0,
+                "min": self.min, "max": self.max, "last": self.last}
+
+
+class Metrics(object):
+    """
+    Timings of the sections of the pipeline (spans), counters and observed values, e.g. tokens/s,
+    aggregated in memory. Each span, value and count can also be appended to a JSONL log as it is
+    recorded. Sections marked as hot are profiled with cProfile, and optionally tracemalloc, once
+    profiling is enabled.
+    """
+
+    def __init__(self):
+        self.spans = {}
+        self.values = {}
+        self.counters = {}
+        self.log = None
+        self.profile_dir = None
+        self.trace_memory = False
+        self._profiles = {}
+        self._profiling = False
+        self._lock = threading.Lock()
+        return
+
+    def open_log(self, path: str):
+        """
+        Appends the spans, values and counts recorded from now on to a JSONL file, one event per line.
+        """
+        self.close_log()
+        self.log = open(path, 'a')
+        return
+
+    def close_log(self):
+        with self._lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+        return
+
+    def _write(self, event):
+        # called with the lock held
+        if self.log is not None:
+            self.log.write(json.dumps(event, default=str) + "\n")
+            self.log.flush()
+        return
+
+    def record_span(self, name: str, duration: float, attributes: dict = None):
+        with self._lock:
+            self.spans.setdefault(name, Stat()).observe(duration)
+            self._write({"time": time.time(), "type": "span", "name": name, "duration": duration, **(attributes or {})})
+        return
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            self.values.setdefault(name, Stat()).observe(value)
+            self._write({"time": time.time(), "type": "value", "name": name, "value": value})
+        return
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self._write({"time": time.time(), "type": "count", "name": name, "value": value})
+        return
+
+    def enable_profiling(self, profile_dir: str = "profiles", memory: bool = False):
+        """
+        Profiles the hot sections, see span(profile=True). The calls of each section are
+        accumulated in profile_dir/<section>.prof, to read with pstats or snakeviz.
+        :param memory: Whether to also trace the memory allocations, and record the peak memory
+            allocated by each section as the value "<section>.peak_bytes". It slows down every allocation.
+        """
+        os.makedirs(profile_dir, exist_ok=True)
+        self.profile_dir = profile_dir
+        self.trace_memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return
+
+    def start_profile(self):
+        """
+        Starts profiling a section if profiling is enabled and no other section is being profiled,
+        since only one profiler can run at a time. Only the calling thread is profiled.
+        :return: State to pass to stop_profile(), or None.
+        """
+        if self.profile_dir is None:
+            return None
+        with self._lock:
+            if self._profiling:
+                return None
+            self._profiling = True
+        memory = None
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is running, e.g. python -m cProfile
+            self._profiling = False
+            return None
+        return profiler, memory
+
+    def stop_profile(self, name: str, state):
+        profiler, memory = state
+        profiler.disable()
+        if memory is not None:
+            self.observe(f"{name}.peak_bytes", tracemalloc.get_traced_memory()[1] - memory)
+        with self._lock:
+            if name in self._profiles:
+                self._profiles[name].add(profiler)
+            else:
+                self._profiles[name] = pstats.Stats(profiler)
+            self._profiles[name].dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+            self._profiling = False
+        return
+
+    def snapshot(self):
+        """
+        Get the aggregated measurements.
+        :return: Dictionary of "spans" and "values" {name: {"count", "total", "mean", "min", "max", "last"}},
+            "counters" {name: count} and "hit_rates" {name: hits / (hits + misses)} of the counters
+            "<name>.hits" and "<name>.misses".
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            snapshot = {
+                "spans": {name: stat.as_dict() for name, stat in self.spans.items()},
+                "values": {name: stat.as_dict() for name, stat in self.values.items()},
+                "counters": counters,
+            }
+        hit_rates = {}
+        for name in counters:
+            if name.endswith(".hits"):
+                cache = name[:-len(".hits")]
+                total = counters[name] + counters.get(cache + ".misses", 0)
+                hit_rates[cache] = counters[name] / total if total else 0.0
+        snapshot["hit_rates"] = hit_rates
+        return snapshot
+
+    def dump(self, path: str):
+        """
+        Appends the snapshot to a JSONL file.
+        """
+        with open(path, 'a') as fo:
+            fo.write(json.dumps({"time": time.time(), "type": "snapshot", **self.snapshot()}) + "\n")
+        return
+
+    def reset(self):
+        with self._lock:
+            self.spans.clear()
+            self.values.clear()
+            self.counters.clear()
+        return
+
+
+# Measurements of the process, recorded by the functions below
+metrics = Metrics()
+
+@contextmanager
+def span(name: str, profile: bool = False, **attributes):
+    """
+    Times a section of code:
+
+        with span("retrieve", frames=2) as attributes:
+            nodes = ...
+            attributes["nodes"] = len(nodes)
+
+    :param name: Name of the section. The durations of the sections of the same name are aggregated.
+    :param profile: Whether the section is profiled when profiling is enabled, see Metrics.enable_profiling().
+    :param attributes: Written with the duration to the JSONL log. More can be added to the yielded dictionary.
+    """
+    state = metrics.start_profile() if profile else None
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        duration = time.perf_counter() - start
+        if state is not None:
+            metrics.stop_profile(name, state)
+        metrics.record_span(name, duration, attributes)
+
+def observe(name: str, value: float):
+    metrics.observe(name, value)
+    return
+
+def count(name: str, value: int = 1):
+    metrics.count(name, value)
+    return
+
+def snapshot():
+    return metrics.snapshot()
+
+
+def load_log(path: str):
+    """
+    Aggregates the events of a JSONL log, e.g. written by a server over a day.
+    :return: Metrics.
+    """
+    loaded = Metrics()
+    with open(path, 'r') as fo:
+        for line in fo:
+            event = json.loads(line)
+            if event.get("type") == "span":
+                loaded.spans.setdefault(event["name"], Stat()).observe(event["duration"])
+            elif event.get("type") == "value":
+                loaded.values.setdefault(event["name"], Stat()).observe(event["value"])
+            elif event.get("type") == "count":
+                loaded.counters[event["name"]] = loaded.counters.get(event["name"], 0) + event["value"]
+    return loaded
+
+def format_snapshot(snapshot: dict):
+    """
+    Formats a snapshot as a text table.
+    """
+    lines = []
+    if snapshot["spans"]:
+        lines.append(f"{'Span':<32}{'count':>7}{'mean s':>10}{'max s':>10}{'total s':>10}")
+        for name, stat in sorted(snapshot["spans"].items()):
+            lines.append(f"{name:<32}{stat['count']:>7}{stat['mean']:>10.3f}{stat['max']:>10.3f}{stat['total']:>10.3f}")
+    if snapshot["values"]:
+        lines.append(f"{'Value':<32}{'count':>7}{'mean':>10}{'min':>10}{'max':>10}")
+        for name, stat in sorted(snapshot["values"].items()):
+            lines.append(f"{name:<32}{stat['count']:>7}{stat['mean']:>10.4g}{stat['min']:>10.4g}{stat['max']:>10.4g}")
+    if snapshot.get("counters"):
+        lines.append(f"{'Counter':<32}{'count':>7}")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name:<32}{value:>7}")
+    for name, rate in sorted(snapshot.get("hit_rates", {}).items()):
+        lines.append(f"{name + ' hit rate':<32}{rate:>7.0%}")
+    return "\n".join(lines) if lines else "Nothing measured yet"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarizes a JSONL metrics log")
+    parser.add_argument('log', type=str, help='JSONL file written with --metrics')
+    args = parser.parse_args()
+    print(format_snapshot(load_log(args.log).snapshot()))
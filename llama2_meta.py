@@ -1,10 +1,13 @@
 import torch
 import transformers
 
-from transformers import LlamaForCausalLM, LlamaTokenizer
+from transformers import LlamaForCausalLM, LlamaTokenizer, TextIteratorStreamer
+from threading import Thread
+from models import GenerationStream, BACKENDS, default_backend, load_cpu_model
+from prefix_cache import PrefixCache
 import time
 
-def generate_result(prompt):
+def generate_result(prompt, streamer=None):
     sequences = pipeline(
         prompt,
         do_sample=True,
@@ -12,37 +15,82 @@ def generate_result(prompt):
         num_return_sequences=1,
         eos_token_id=tokenizer.eos_token_id,
         max_length=800,
+        streamer=streamer,
     )
     return sequences
 
-def keep_asking():
+def stream_result(prompt):
+    """
+    Generates the result piece by piece, as the tokens are generated. The prompt is not repeated.
+    :return: GenerationStream of the generated text. Its stats() give the time to first token and tokens/s.
+        Raises the error of the generation, if any, once the pieces generated before it are read.
+    """
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    def generate():
+        try:
+            generate_result(prompt, streamer)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # otherwise the streamer waits for the end forever if the generation fails
+            streamer.end()
+
+    def pieces():
+        yield from streamer
+        if errors:
+            raise errors[0]
+
+    Thread(target=generate, daemon=True).start()
+    return GenerationStream(pieces(), lambda text: len(tokenizer.encode(text, add_special_tokens=False)))
+
+def print_stream(stream):
+    for text in stream:
+        print(text, end="", flush=True)
+    print()
+    print(f"({stream.summary()})")
+
+def keep_asking(prefix=""):
+    """
+    :param prefix: Text put before every prompt, e.g. an example. Add it to a PrefixCache attached to
+        the model so that it is only computed once.
+    """
     while True:
         prompt = input(">>> Prompt: ")
-        sequences = generate_result(prompt + "\n")
-        for seq in sequences:
-            print(f"{seq['generated_text']}")
+        print_stream(stream_result(prefix + prompt + "\n"))
 
 def ask_once(prompt):
     start_time = time.time()
-    sequences = generate_result(prompt + "\n")
-    for seq in sequences:
-        print(f"{seq['generated_text']}")
+    print(prompt)
+    print_stream(stream_result(prompt + "\n"))
     print(f"Result generating finished, elapsed time: {time.time() - start_time:.2f}s")
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', type=str, default=None, choices=BACKENDS, help='Where and how the model runs. Defaults to "cuda" if a GPU is available, "cpu-int8" otherwise')
+    parser.add_argument('--threads', type=int, default=None, help='Number of CPU threads of the CPU backends')
+    args = parser.parse_args()
+    backend = args.backend or default_backend()
+
     model_dir = "./llama/llama-2-7b-chat-hf"
-    model = LlamaForCausalLM.from_pretrained(model_dir)
     tokenizer = LlamaTokenizer.from_pretrained(model_dir)
+    if backend == "cuda":
+        model = LlamaForCausalLM.from_pretrained(model_dir)
+        pipeline = transformers.pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=tokenizer,
+            torch_dtype=torch.float16,
+            device_map="auto",
+        )
+    else:
+        model = load_cpu_model(model_dir, backend, args.threads)
+        pipeline = transformers.pipeline("text-generation", model=model, tokenizer=tokenizer)
 
-    pipeline = transformers.pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-        torch_dtype=torch.float16,
-        device_map="auto",
-    )
-
-    prompt = '''Here is an example of frame blending: 
+    example = '''Here is an example of frame blending: 
     Expression: "Time is money."
     Frames Involved:
     Time Frame: This involves concepts related to the passage of time, such as hours, minutes, schedules, deadlines, etc.
@@ -57,5 +105,8 @@ if __name__ == "__main__":
     In the blended space, time is conceptualized as a valuable commodity that can be budgeted, spent wisely, or wasted, similar to how money is managed.
     Emergent Structure:
     This blend creates a new understanding where activities are seen through the lens of financial transactions. For example, "wasting time" implies a loss similar to wasting money, highlighting the value and scarcity of time.
-    Give me another example of frame blending based on the example I gave you.'''
+    '''
+    # prompts starting with the example reuse its keys and values instead of computing them again
+    PrefixCache(model, tokenizer).attach().add_prefix(example)
+    prompt = example + "Give me another example of frame blending based on the example I gave you."
     ask_once(prompt)
@@ -1,4 +1,148 @@
-def llama2_llamaindex():
+import os
+import time
+
+class GenerationStream(object):
+    """
+    Iterator over the pieces of text of a generation, as they are generated. Measures the time to
+    the first piece and the generation speed, see stats().
+    """
+
+    def __init__(self, pieces, count_tokens=None):
+        """
+        :param pieces: Iterator of generated text pieces.
+        :param count_tokens: Function counting the tokens of a text, e.g. from the model's tokenizer.
+            Defaults to counting the pieces.
+        """
+        self.pieces = pieces
+        self.count_tokens = count_tokens
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.end_time = None
+        self._text = []
+        return
+
+    @property
+    def text(self):
+        """
+        Text generated so far.
+        """
+        return "".join(self._text)
+
+    def __iter__(self):
+        for piece in self.pieces:
+            if self.first_token_time is None:
+                self.first_token_time = time.perf_counter()
+            self._text.append(piece)
+            yield piece
+        self.end_time = time.perf_counter()
+        return
+
+    def close(self):
+        if hasattr(self.pieces, "close"):
+            self.pieces.close()
+        return
+
+    def restart(self):
+        """
+        Starts measuring again from now, e.g. once the prompt is ready to be generated from.
+        """
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        return
+
+    def stats(self):
+        """
+        Get the timing of the generation, measured up to now if the iteration is not finished.
+        :return: Dictionary of "time_to_first_token" and "total_time" in seconds, "tokens" generated,
+            and "tokens_per_second" after the first token, 0 if the text came in one piece.
+        """
+        end_time = self.end_time or time.perf_counter()
+        text = self.text
+        tokens = self.count_tokens(text) if self.count_tokens and text else len(self._text)
+        first_token_time = self.first_token_time or end_time
+        decode_time = end_time - first_token_time
+        streamed = len(self._text) > 1
+        return {
+            "time_to_first_token": first_token_time - self.start_time,
+            "total_time": end_time - self.start_time,
+            "tokens": tokens,
+            "tokens_per_second": (tokens - 1) / decode_time if streamed and tokens > 1 and decode_time > 0 else 0.0,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return f"{stats['tokens']} tokens in {stats['total_time']:.2f}s, first token after {stats['time_to_first_token']:.2f}s, {stats['tokens_per_second']:.1f} tokens/s"
+
+
+# "cuda": 8-bit weights with bitsandbytes, spread over the GPUs
+# "cpu-int8": linear layers dynamically quantized to int8, the rest in float32, on the CPU
+# "cpu-bf16": bfloat16 weights on the CPU
+BACKENDS = ["cuda", "cpu-int8", "cpu-bf16"]
+
+def default_backend():
+    """
+    Get the backend set by the LLM_BACKEND environment variable, otherwise "cuda" if a GPU is
+    available and "cpu-int8" if not.
+    """
+    backend = os.getenv("LLM_BACKEND")
+    if backend:
+        assert backend in BACKENDS, f'''Please set LLM_BACKEND to one of the backends: ['{"', '".join(BACKENDS)}']'''
+        return backend
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu-int8"
+
+def configure_threads(threads=None, interop_threads=None):
+    """
+    Sets the number of threads torch uses on the CPU.
+    :param threads: Threads of each operation. Defaults to the CPUs available to the process, which
+        may be fewer than the CPUs of the node, e.g. in a batch job.
+    :param interop_threads: Threads running independent operations in parallel. Defaults to a quarter
+        of threads, at most 4. It can only be set before torch runs anything in parallel.
+    :return: Number of threads.
+    """
+    import torch
+    threads = threads or len(os.sched_getaffinity(0))
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop_threads or max(1, min(4, threads // 4)))
+    except RuntimeError:
+        # already set, or torch already ran parallel work
+        pass
+    return threads
+
+def load_cpu_model(model_name, backend="cpu-int8", threads=None):
+    """
+    Loads a causal LM for the CPU. The checkpoint shards are loaded one at a time into bfloat16
+    weights. For "cpu-int8", the decoder layers are then converted to float32 and quantized one at a
+    time, so that the whole model is never in float32.
+    :param model_name: Model name on Hugging Face, or a local directory.
+    :param backend: "cpu-int8" or "cpu-bf16".
+    :param threads: Number of CPU threads, see configure_threads().
+    :return: Model in evaluation mode.
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    assert backend in ["cpu-int8", "cpu-bf16"], "Please enter one of the CPU backends: ['cpu-int8', 'cpu-bf16']"
+    configure_threads(threads)
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True)
+    model.eval()
+    if backend == "cpu-int8":
+        for layer in getattr(getattr(model, "model", None), "layers", []):
+            torch.ao.quantization.quantize_dynamic(layer.float(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        # embeddings, norms and the output layer
+        model.float()
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def llama2_llamaindex(prefix_cache=True, backend=None, threads=None):
+    """
+    :param prefix_cache: Whether the keys and values of the system prompt, which starts every prompt,
+        are computed once and reused by the generations, see PrefixCache.
+    :param backend: One of BACKENDS. Defaults to default_backend().
+    :param threads: Number of CPU threads of the CPU backends, see configure_threads().
+    """
     from torch import float16
     from llama_index.llms.huggingface import HuggingFaceLLM
     from llama_index.core import PromptTemplate
@@ -23,17 +167,29 @@ def llama2_llamaindex():
         "[INST]<<SYS>>\n" + SYSTEM_PROMPT + "<</SYS>>\n\n{query_str}[/INST] "
     )
 
-    return HuggingFaceLLM(
+    backend = backend or default_backend()
+    if backend == "cuda":
+        model_settings = dict(
+            device_map="auto",
+            # change these settings below depending on your GPU
+            model_kwargs={"torch_dtype": float16, "load_in_8bit": True},
+        )
+    else:
+        model_settings = dict(device_map="cpu", model=load_cpu_model(LLAMA2_7B_CHAT, backend, threads))
+    llm = HuggingFaceLLM(
         context_window=4096,
         max_new_tokens=2048,
         generate_kwargs={"temperature": 0.9, "do_sample": True},
         query_wrapper_prompt=query_wrapper_prompt,
         tokenizer_name=LLAMA2_7B_CHAT,
         model_name=LLAMA2_7B_CHAT,
-        device_map="auto",
-        # change these settings below depending on your GPU
-        model_kwargs={"torch_dtype": float16, "load_in_8bit": True},
+        **model_settings,
     )
+    if prefix_cache:
+        from prefix_cache import PrefixCache
+        # every prompt starts with the system prompt
+        PrefixCache(llm._model, llm._tokenizer).attach().add_prefix(query_wrapper_prompt.template.split("{query_str}")[0])
+    return llm
 
 def llama2_ollama():
     from llama_index.llms.ollama import Ollama
@@ -0,0 +1,320 @@
+import json
+import os
+from typing import Any, List
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+# Name of the default vector store file in a persist dir, as StorageContext.persist() writes it
+VECTOR_STORE_FNAME = "default__vector_store.json"
+# Rows converted to float32 at a time when scoring a float16 matrix
+SCORE_BLOCK_ROWS = 8192
+
+
+def matrix_path(persist_path: str, version: int = None):
+    """
+    Get the path of the embedding matrix persisted next to the id and metadata file persist_path.
+    :param version: Number of the persisted matrix, see NumpyVectorStore.persist(). None for the
+        unnumbered matrix of stores persisted before matrices were numbered.
+    """
+    stem = os.path.splitext(persist_path)[0]
+    return f"{stem}.npy" if version is None else f"{stem}.{version}.npy"
+
+def load_matrix(path: str):
+    """
+    Memory-maps a saved matrix, except an empty one, which cannot be mapped.
+    """
+    matrix = np.load(path, mmap_mode='r')
+    return matrix if matrix.size else np.array(matrix)
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    Vector store keeping the embeddings in one NumPy matrix, one normalized row per node, with the
+    node ids, document ids and metadata in a JSON file next to it. A persisted matrix is memory-mapped
+    instead of read, so loading takes no time and the rows are only paged in by the queries.
+    The similarity is the cosine similarity, as in llama-index's SimpleVectorStore.
+    """
+
+    stores_text: bool = False
+    dtype: str = "float32"
+
+    _matrix: Any = PrivateAttr()
+    _ids: List[str] = PrivateAttr()
+    _ref_doc_ids: List[str] = PrivateAttr()
+    _metadata: List[dict] = PrivateAttr()
+    _alive: Any = PrivateAttr()
+    _rows: dict = PrivateAttr()
+    _doc_rows: dict = PrivateAttr()
+    _columns: dict = PrivateAttr()
+
+    def __init__(self, dtype: str = "float32", **kwargs: Any):
+        """
+        :param dtype: Type of the stored embeddings, "float32" or "float16" (half the size, the
+            scores are still computed in float32).
+        """
+        assert dtype in ["float32", "float16"], "Please enter one of the dtypes: ['float32', 'float16']"
+        super().__init__(dtype=dtype, **kwargs)
+        self._set_rows(np.zeros((0, 0), dtype=dtype), [], [], [])
+        return
+
+    def _set_rows(self, matrix, ids, ref_doc_ids, metadata):
+        self._matrix = matrix
+        self._ids = ids
+        self._ref_doc_ids = ref_doc_ids
+        self._metadata = metadata
+        self._index_rows()
+        return
+
+    def _index_rows(self):
+        # rows of deleted nodes are only masked out, and dropped when the matrix is next rewritten
+        self._alive = np.ones(len(self._ids), dtype=bool)
+        self._rows = {node_id: row for row, node_id in enumerate(self._ids)}
+        self._doc_rows = {}
+        for row, ref_doc_id in enumerate(self._ref_doc_ids):
+            self._doc_rows.setdefault(ref_doc_id, []).append(row)
+        # _columns[key]: metadata value of each row, for vectorized filters
+        self._columns = {}
+        return
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str):
+        """
+        Loads the vector store persisted in a directory by StorageContext.persist().
+        :return: NumpyVectorStore, with the type of the saved embeddings.
+        """
+        return cls.from_persist_path(os.path.join(persist_dir, VECTOR_STORE_FNAME))
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str):
+        with open(persist_path, 'r') as fo:
+            data = json.load(fo)
+        path = matrix_path(persist_path, data.get("matrix_version"))
+        matrix = load_matrix(path)
+        if matrix.shape[0] != len(data["ids"]):
+            raise ValueError(f"{path} has {matrix.shape[0]} rows for {len(data['ids'])} nodes")
+        store = cls(dtype=str(matrix.dtype))
+        store._set_rows(matrix, data["ids"], data["ref_doc_ids"], data["metadata"])
+        return store
+
+    @staticmethod
+    def exists(persist_dir: str):
+        """
+        Whether a NumpyVectorStore is persisted in a directory.
+        """
+        return os.path.exists(os.path.join(persist_dir, VECTOR_STORE_FNAME))
+
+    def set_dtype(self, dtype: str):
+        """
+        Converts the stored embeddings to another type. The matrix is read into memory until it is persisted.
+        """
+        assert dtype in ["float32", "float16"], "Please enter one of the dtypes: ['float32', 'float16']"
+        if dtype != self.dtype:
+            self.dtype = dtype
+            self._matrix = self._matrix.astype(dtype)
+        return
+
+    @property
+    def client(self):
+        return None
+
+    def _compact(self, new_rows=None):
+        """
+        Drops the deleted rows and appends new_rows, in one copy of the matrix.
+        """
+        keep = np.flatnonzero(self._alive)
+        matrix = self._matrix if len(keep) == len(self._ids) else self._matrix[keep]
+        if new_rows is not None:
+            matrix = new_rows if matrix.shape[0] == 0 else np.concatenate([matrix, new_rows])
+        self._set_rows(
+            np.asarray(matrix, dtype=self.dtype),
+            [self._ids[row] for row in keep],
+            [self._ref_doc_ids[row] for row in keep],
+            [self._metadata[row] for row in keep],
+        )
+        return
+
+    def add(self, nodes: list, **kwargs: Any):
+        """
+        Adds the embeddings of nodes, replacing those of nodes with the same ids.
+        :return: List of node ids.
+        """
+        if not nodes:
+            return []
+        embeddings = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms > 0, norms, 1)
+        if self._matrix.shape[0] and embeddings.shape[1] != self._matrix.shape[1]:
+            raise ValueError(f"Embeddings of size {embeddings.shape[1]} added to a store of size {self._matrix.shape[1]}")
+        for node in nodes:
+            if node.node_id in self._rows:
+                self._alive[self._rows[node.node_id]] = False
+        self._compact(embeddings.astype(self.dtype))
+        # _compact() copied the lists of the remaining rows
+        self._ids += [node.node_id for node in nodes]
+        self._ref_doc_ids += [node.ref_doc_id for node in nodes]
+        self._metadata += [dict(node.metadata) for node in nodes]
+        self._index_rows()
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any):
+        """
+        Deletes the embeddings of the nodes of a document.
+        """
+        self._alive[self._doc_rows.get(ref_doc_id, [])] = False
+        return
+
+    def delete_nodes(self, node_ids: list = None, filters=None, **delete_kwargs: Any):
+        """
+        Deletes the embeddings of nodes by id, or of the nodes matching metadata filters.
+        """
+        mask = self._alive.copy()
+        if node_ids is not None:
+            mask &= self._rows_mask(self._rows[node_id] for node_id in node_ids if node_id in self._rows)
+        if filters is not None:
+            mask &= self._filter_mask(filters)
+        self._alive &= ~mask
+        return
+
+    def clear(self):
+        self._alive[:] = False
+        return
+
+    def _column(self, key):
+        if key not in self._columns:
+            column = np.empty(len(self._metadata), dtype=object)
+            column[:] = [metadata.get(key) for metadata in self._metadata]
+            self._columns[key] = column
+        return self._columns[key]
+
+    def _rows_mask(self, rows):
+        """
+        Get a boolean array of the given rows. The rows of ids are looked up in the row indexes,
+        np.isin() on arrays of strings compares every pair.
+        """
+        mask = np.zeros(len(self._ids), dtype=bool)
+        mask[np.fromiter(rows, dtype=np.int64)] = True
+        return mask
+
+    def _filter_mask(self, filters):
+        """
+        Get the rows matching metadata filters, as a boolean array.
+        """
+        masks = []
+        for filter_ in filters.filters:
+            if hasattr(filter_, "filters"):
+                masks.append(self._filter_mask(filter_))
+                continue
+            column = self._column(filter_.key)
+            operator = filter_.operator
+            if operator == FilterOperator.EQ:
+                mask = column == filter_.value
+            elif operator == FilterOperator.NE:
+                mask = column != filter_.value
+            elif operator in [FilterOperator.IN, FilterOperator.NIN]:
+                values = set(filter_.value)
+                mask = np.fromiter((value in values for value in column), dtype=bool, count=len(column))
+                if operator == FilterOperator.NIN:
+                    mask = ~mask
+            else:
+                raise ValueError(f"Unsupported filter operator: {operator}")
+            masks.append(np.asarray(mask, dtype=bool))
+        if not masks:
+            return np.ones(len(self._ids), dtype=bool)
+        if filters.condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+    def _scores(self, query_embedding, rows):
+        """
+        Computes the similarity of the query to the given rows, or to every row if rows is None.
+        """
+        matrix = self._matrix if rows is None else self._matrix[rows]
+        if matrix.dtype == np.float32:
+            return matrix @ query_embedding
+        return np.concatenate([
+            matrix[start:start + SCORE_BLOCK_ROWS].astype(np.float32) @ query_embedding
+            for start in range(0, matrix.shape[0], SCORE_BLOCK_ROWS)
+        ])
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any):
+        """
+        Finds the similarity_top_k nodes closest to the query embedding, among the nodes matching
+        the query filters, node ids and document ids.
+        """
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Unsupported query mode: {query.mode}")
+        mask = self._alive.copy()
+        if query.filters is not None:
+            mask &= self._filter_mask(query.filters)
+        if query.node_ids is not None:
+            mask &= self._rows_mask(self._rows[node_id] for node_id in query.node_ids if node_id in self._rows)
+        if query.doc_ids is not None:
+            mask &= self._rows_mask(row for doc_id in query.doc_ids for row in self._doc_rows.get(doc_id, []))
+        rows = np.flatnonzero(mask)
+        k = min(query.similarity_top_k, len(rows))
+        if k == 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query_embedding)
+        if norm > 0:
+            query_embedding /= norm
+        scores = self._scores(query_embedding, None if len(rows) == len(self._ids) else rows)
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return VectorStoreQueryResult(
+            nodes=None,
+            similarities=scores[top].tolist(),
+            ids=[self._ids[rows[i]] for i in top],
+        )
+
+    def persist(self, persist_path: str, fs=None):
+        """
+        Saves the matrix to a new numbered .npy file next to persist_path, then the ids, metadata and
+        number of the matrix to persist_path, which is replaced in one step: if saving is interrupted,
+        the previous matrix and its ids stay in use. The previous matrix is then deleted, and the
+        new one memory-mapped.
+        """
+        self._compact()
+        if os.path.dirname(persist_path):
+            os.makedirs(os.path.dirname(persist_path), exist_ok=True)
+        old_paths = self._matrix_paths(persist_path)
+        version = 1 + max(old_paths.values(), default=0)
+        path = matrix_path(persist_path, version)
+        with open(path + ".tmp", 'wb') as fo:
+            np.save(fo, np.ascontiguousarray(self._matrix))
+        os.replace(path + ".tmp", path)
+        with open(persist_path + ".tmp", 'w') as fo:
+            json.dump({"ids": self._ids, "ref_doc_ids": self._ref_doc_ids, "metadata": self._metadata, "matrix_version": version}, fo)
+        os.replace(persist_path + ".tmp", persist_path)
+        # a memory-mapped matrix stays readable after its file is deleted
+        for old_path in old_paths:
+            os.remove(old_path)
+        self._matrix = load_matrix(path)
+        return
+
+    @staticmethod
+    def _matrix_paths(persist_path: str):
+        """
+        Get the matrices persisted next to persist_path, including those left by an interrupted persist().
+        :return: Dictionary mapping each path to its number, 0 for the unnumbered matrix.
+        """
+        stem = os.path.basename(os.path.splitext(persist_path)[0])
+        paths = {}
+        for file in os.listdir(os.path.dirname(persist_path) or "."):
+            parts = file.split(".")
+            if file.startswith(stem + ".") and parts[-1] == "npy" and len(parts) <= 3:
+                if len(parts) == 2:
+                    paths[matrix_path(persist_path)] = 0
+                elif parts[1].isdigit():
+                    paths[matrix_path(persist_path, int(parts[1]))] = int(parts[1])
+        return paths
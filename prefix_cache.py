@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+from instrumentation import count, observe
+
+
+class PrefixCache(object):
+    """
+    Keys and values of the attention layers for prompt prefixes shared by many prompts, e.g. the
+    system prompt. Once attached to a transformers model, its generate() starts from the cached
+    keys and values of the longest matching prefix and only computes the rest of the prompt.
+    The least recently used prefixes are evicted above max_bytes.
+    """
+
+    def __init__(self, model, tokenizer, max_bytes: int = 512 << 20):
+        """
+        :param model: Causal LM, e.g. the _model of a HuggingFaceLLM.
+        :param tokenizer: Its tokenizer.
+        :param max_bytes: Maximum total size of the cached keys and values.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_bytes = max_bytes
+        # entries[prefix token ids]: (token id tensor, past key values in the legacy tuple format, size in bytes)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.reused_tokens = 0
+        self._lock = threading.Lock()
+        self._generate = None
+        return
+
+    def size(self):
+        """
+        Get the total size of the cached keys and values in bytes.
+        """
+        with self._lock:
+            return sum(entry[2] for entry in self.entries.values())
+
+    def add_prefix(self, text: str):
+        """
+        Computes the keys and values of a prefix, tokenized as at the start of a prompt.
+        :param text: Text every prompt using the cache starts with.
+        """
+        ids = self.tokenizer(text, return_tensors="pt").input_ids[0]
+        key = tuple(ids.tolist())
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+        with torch.no_grad():
+            outputs = self.model(input_ids=ids[None].to(self.model.device), use_cache=True)
+        past_key_values = outputs.past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        size = sum(tensor.numel() * tensor.element_size() for layer in past_key_values for tensor in layer[:2])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self.entries[key] = (ids, past_key_values, size)
+            total = sum(entry[2] for entry in self.entries.values())
+            while total > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                total -= evicted
+        return
+
+    def lookup(self, input_ids):
+        """
+        Finds the cached prefix sharing the most tokens with a prompt. At least the last token of the
+        prompt is left to compute, since generate() needs one.
+        :param input_ids: Token ids of the prompt, 1-dimensional.
+        :return: Past key values covering the shared tokens, or None.
+        """
+        input_ids = input_ids.cpu()
+        best_key, best_length = None, 0
+        with self._lock:
+            for key, (ids, _, _) in self.entries.items():
+                length = min(len(ids), len(input_ids) - 1)
+                if length <= best_length:
+                    continue
+                different = (ids[:length] != input_ids[:length]).nonzero()
+                shared = int(different[0]) if len(different) else length
+                if shared > best_length:
+                    best_key, best_length = key, shared
+            if best_key is None:
+                count("prefix_cache.misses")
+                return None
+            self.entries.move_to_end(best_key)
+            _, past_key_values, _ = self.entries[best_key]
+            self.hits += 1
+            self.reused_tokens += best_length
+        count("prefix_cache.hits")
+        observe("prefix_cache.reused_tokens", best_length)
+        # the model concatenates the new keys and values to these slices, the cached tensors are not modified
+        return tuple(tuple(tensor[:, :, :best_length] for tensor in layer) for layer in past_key_values)
+
+    def attach(self):
+        """
+        Wraps model.generate() so that single prompts starting with a cached prefix reuse its keys and
+        values. Batches, and calls already given past_key_values, are generated as before.
+        :return: self, also set as model.prefix_cache.
+        """
+        if self._generate is not None:
+            return self
+        self._generate = self.model.generate
+
+        def generate(input_ids=None, **kwargs):
+            if input_ids is not None and input_ids.shape[0] == 1 and kwargs.get("past_key_values") is None:
+                past_key_values = self.lookup(input_ids[0])
+                if past_key_values is not None:
+                    kwargs["past_key_values"] = past_key_values
+            return self._generate(input_ids=input_ids, **kwargs)
+
+        self.model.generate = generate
+        self.model.prefix_cache = self
+        return self
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+        return
@@ -8,86 +8,613 @@ import os.path
 from dotenv import load_dotenv
 load_dotenv()
 from os import getenv
-from huggingface_hub import login 
-login(token=getenv("HUGGINGFACE_API_KEY"))
-
-from models import llama2_llamaindex, embed_model
-from llama_index.core import Settings, SimpleDirectoryReader, VectorStoreIndex, StorageContext, load_index_from_storage
-from llama_index.readers.json import JSONReader
-
-def get_query_engine(save_index=True):
-    Settings.llm = llama2_llamaindex()
-    Settings.embed_model = embed_model()
-    PERSIST_DIR = "./query_engine.index"
-    if os.path.exists(PERSIST_DIR):
-        storage_context = StorageContext.from_defaults(persist_dir=PERSIST_DIR)
-        index = load_index_from_storage(storage_context)
-        print(f"Loaded model from {PERSIST_DIR}")
-    else:
-        parser = JSONReader()
-        file_extractor = {".json": parser}
-        documents = SimpleDirectoryReader("frame_json/", file_extractor=file_extractor).load_data()
-        print("Finished loading data")
 
-        index = VectorStoreIndex.from_documents(documents)
-        print("Finished creating index")
+from models import llama2_llamaindex, embed_model, GenerationStream
+from frame_store import open_store
+from response_cache import response_key
+from numpy_vector_store import NumpyVectorStore
+from inference_server import RemoteQueryEngine
+from conversation_memory import ConversationMemory
+from instrumentation import span, count, observe, metrics
+from llama_index.core import Settings, VectorStoreIndex, StorageContext, load_index_from_storage
+from llama_index.core.schema import TextNode, NodeRelationship, RelatedNodeInfo
+from llama_index.core.vector_stores import MetadataFilters, MetadataFilter, FilterCondition
+import hashlib
+import json
+import threading
+
+PERSIST_DIR = "./query_engine.index"
+# Frame hashes of the persisted index, to find the frames to embed again
+FRAME_HASHES = "frame_hashes.json"
+# Changing how frames are split into chunks changes every frame hash
+CHUNKING_VERSION = 1
+# Longest text of a lexical units or examples chunk, longer sections are split
+MAX_CHUNK_CHARS = 2000
+
+def frame_hash(data):
+    """
+    Get the hash of the data of a frame, which changes whenever its chunks change.
+    """
+    content = json.dumps([CHUNKING_VERSION, data], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+def split_lines(lines, max_chars=MAX_CHUNK_CHARS):
+    """
+    Groups lines into texts of at most max_chars characters, a longer line making its own text.
+    """
+    texts, current, size = [], [], 0
+    for line in lines:
+        if current and size + len(line) > max_chars:
+            texts.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        texts.append("\n".join(current))
+    return texts
+
+def frame_nodes(frame, data):
+    """
+    Splits a frame into chunks along its JSON structure: the definition with the frame relations,
+    one chunk per frame element, then the lexical units and the examples. Every chunk starts with
+    the frame name and has it as "frame_name" metadata, for filtering.
+    :param frame: Frame name, as the JSON file is named.
+    :param data: Frame data from a frame store.
+    :return: List of TextNode, whose source document is the frame.
+    """
+    sections = []
+    relations = [f"{relation}: {frames}" for relation, frames in (data.get("fr_rel") or {}).items()]
+    sections.append(("definition", "definition", [f"Definition: {data.get('frame_def') or ''}"] + relations))
+    for element, definition in (data.get("fe_def") or {}).items():
+        sections.append((f"fe:{element}", "frame_element", [f"Frame element {element}: {definition}"]))
+    lexical = [f"{unit}: {definition}" for unit, definition in (data.get("lexical") or {}).items()]
+    for i, text in enumerate(split_lines(lexical)):
+        sections.append((f"lexical:{i}", "lexical_units", ["Lexical units:", text]))
+    examples = [
+        f"{sentence} ({'; '.join(f'{span}: {label}' for span, label in (labels or {}).items())})"
+        for sentence, labels in (data.get("examples") or {}).items()
+    ]
+    for i, text in enumerate(split_lines(examples)):
+        sections.append((f"examples:{i}", "examples", ["Examples:", text]))
+
+    nodes = []
+    for name, section, lines in sections:
+        node = TextNode(
+            id_=f"{frame}:{name}",
+            text="\n".join([f"Frame: {frame}"] + lines),
+            metadata={"frame_name": frame, "section": section},
+            # the text already starts with the frame name
+            excluded_embed_metadata_keys=["frame_name", "section"],
+            excluded_llm_metadata_keys=["frame_name", "section"],
+        )
+        node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=frame)
+        nodes.append(node)
+    return nodes
+
+def load_models(backend=None, threads=None):
+    """
+    Loads the LLM and the embedding model used by the index and the query engines.
+    :param backend: Where and how the LLM runs, one of models.BACKENDS. Defaults to models.default_backend().
+    :param threads: Number of CPU threads of the CPU backends. Defaults to the available CPUs.
+    """
+    from huggingface_hub import login
+    login(token=getenv("HUGGINGFACE_API_KEY"))
+    with span("load_models", backend=backend):
+        Settings.llm = llama2_llamaindex(backend=backend, threads=threads)
+        Settings.embed_model = embed_model()
+    prefix_cache = getattr(getattr(Settings.llm, "_model", None), "prefix_cache", None)
+    if prefix_cache is not None:
+        # the question-answer prompt of the query engines starts the same way after the system prompt
+        from llama_index.core.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT_TMPL
+        query_wrapper = Settings.llm.query_wrapper_prompt.template.split("{query_str}")[0]
+        prefix_cache.add_prefix(query_wrapper + DEFAULT_TEXT_QA_PROMPT_TMPL.split("{context_str}")[0])
+    return
+
+def get_index(save_index=True, json_folder_path="frame_json/", persist_dir=PERSIST_DIR, dtype="float32"):
+    """
+    Loads the vector store index of the frames, and brings it up to date with the frame data: only
+    the chunks of added or changed frames are embedded, and the chunks of removed frames are deleted.
+    An index without frame hashes, e.g. saved before frames were chunked, is built again.
+    The embedding model is the one of load_models(). The embeddings are kept in a NumpyVectorStore,
+    memory-mapped from persist_dir.
+    :param save_index: Whether to save the index to persist_dir when it changed.
+    :param json_folder_path: Folder of JSON files used when there is no packed frame store.
+    :param dtype: Type of the stored embeddings, "float32" or "float16".
+    :return: VectorStoreIndex.
+    """
+    hashes_path = os.path.join(persist_dir, FRAME_HASHES)
+    index = None
+    if os.path.exists(hashes_path) and NumpyVectorStore.exists(persist_dir):
+        try:
+            with span("index_load"):
+                vector_store = NumpyVectorStore.from_persist_dir(persist_dir)
+                # embeddings saved with another type are converted, and saved again
+                converted = vector_store.dtype != dtype
+                vector_store.set_dtype(dtype)
+                index = load_index_from_storage(StorageContext.from_defaults(persist_dir=persist_dir, vector_store=vector_store))
+            with open(hashes_path, 'r') as fo:
+                indexed = json.load(fo)
+            print(f"Loaded index from {persist_dir}")
+        except (OSError, ValueError, KeyError) as e:
+            # e.g. files of different saves, if saving was interrupted before matrices were numbered
+            print(f"[Warning] Building the index again, failed to load {persist_dir}: {e}")
+            index = None
+    if index is None:
+        vector_store = NumpyVectorStore(dtype)
+        index = VectorStoreIndex(nodes=[], storage_context=StorageContext.from_defaults(vector_store=vector_store))
+        indexed = {}
+        converted = False
+
+    store = open_store(json_folder_path=json_folder_path)
+    hashes, nodes = {}, []
+    for frame, data in store.items():
+        hashes[frame] = frame_hash(data)
+        if indexed.get(frame) != hashes[frame]:
+            nodes += frame_nodes(frame, data)
+    store.close()
+    changed = [frame for frame in hashes if indexed.get(frame) != hashes[frame]]
+    removed = [frame for frame in indexed if frame not in hashes]
+    for frame in removed + [frame for frame in changed if frame in indexed]:
+        index.delete_ref_doc(frame, delete_from_docstore=True)
+    if nodes:
+        with span("embed", profile=True, frames=len(changed), chunks=len(nodes)):
+            index.insert_nodes(nodes)
+    if changed or removed:
+        print(f"Finished indexing {len(changed)} added or changed frames ({len(nodes)} chunks), {len(removed)} removed frames")
+    if changed or removed or converted:
         if save_index:
-            index.storage_context.persist(persist_dir=PERSIST_DIR)
-            print(f"Finished saving index to {PERSIST_DIR}")
+            with span("index_save"):
+                index.storage_context.persist(persist_dir=persist_dir)
+            # written last: if saving is interrupted, the frames are indexed again next time
+            with open(hashes_path, 'w') as fo:
+                json.dump(hashes, fo)
+            print(f"Finished saving index to {persist_dir}")
+    return index
 
-    query_engine = index.as_query_engine()
-    print("Finished creating query engine")
+def frame_filters(frames):
+    """
+    Get the metadata filters retrieving only the chunks of some frames, or None for all frames.
+    """
+    if not frames:
+        return None
+    return MetadataFilters(
+        filters=[MetadataFilter(key="frame_name", value=frame) for frame in frames],
+        condition=FilterCondition.OR,
+    )
+
+def get_query_engine(save_index=True, streaming=False, frames=None, index=None, similarity_top_k=4, server=None):
+    """
+    Creates a query engine over the frame index.
+    :param save_index: Whether to save the index to ./query_engine.index/ when it changed.
+    :param streaming: Whether the responses are generated piece by piece, see stream_response().
+    :param frames: Only retrieve the chunks of these frames, e.g. the frames being blended. Defaults to all frames.
+    :param index: Index from get_index() to query, after load_models(), e.g. to create engines for
+        other frames without loading the models again. Defaults to loading the models and the index.
+    :param similarity_top_k: Number of chunks retrieved for each query.
+    :param server: Address of a running inference_server, see inference_server.parse_address(). The
+        query engine is then a RemoteQueryEngine sending the prompts to the server, and nothing is loaded.
+    :return: Query engine.
+    """
+    if server is not None:
+        return RemoteQueryEngine(server, frames)
+    loaded = index is None
+    if loaded:
+        load_models()
+        index = get_index(save_index)
+    query_engine = index.as_query_engine(streaming=streaming, filters=frame_filters(frames), similarity_top_k=similarity_top_k)
+    # engines created from a given index, e.g. in frame_blender, are created silently
+    if loaded:
+        print("Finished creating query engine")
     return query_engine
 
 
-def generate_response(query_engine, prompt, display=True):
-    response = query_engine.query(prompt)
+def generate_response(query_engine, prompt, display=True, stream=False, cache=None):
+    """
+    Generates the response to a prompt.
+    :param display: Whether to print the prompt and the response.
+    :param stream: Return a GenerationStream yielding the response piece by piece instead, see stream_response().
+        Nothing is printed then.
+    :param cache: ResponseCache to reuse the response of an identical query (same prompt, retrieved
+        context, model and generation parameters). None to always generate, e.g. for a new sample.
+    :return: Response text, or GenerationStream.
+    """
+    generation = stream_response(query_engine, prompt, cache)
+    if stream:
+        return generation
+    response = "".join(generation)
     if display:
         print("\n**_prompt_**\n")
         print(prompt)
         print("\n**_response_**\n")
         print(response)
-    return str(response)
+    return response
+
+
+def stream_response(query_engine, prompt, cache=None, cancel=None):
+    """
+    Generates the response to a prompt piece by piece, as the tokens are generated. With the
+    transformers model of llama2_llamaindex, the response is always streamed; with other LLMs, the
+    query engine needs to be created with streaming=True, otherwise the whole response comes at once.
+    :param cache: ResponseCache to reuse the response of an identical query. None to always generate.
+    :param cancel: threading.Event of this generation only, set from another thread to stop it
+        after the current token, or before it starts if it is still retrieving.
+    :return: GenerationStream of the response text. Its stats() give the time to first token and tokens/s.
+    """
+    if isinstance(query_engine, RemoteQueryEngine):
+        return query_engine.stream(prompt, use_cache=cache is not None)
+    generation = GenerationStream(None, token_counter())
+    generation.pieces = response_pieces(query_engine, prompt, generation, cache, cancel)
+    return generation
+
+def token_counter():
+    """
+    Get a function counting the tokens of a text with the tokenizer of the loaded LLM, or None if
+    it has no tokenizer.
+    """
+    tokenizer = getattr(Settings.llm, "_tokenizer", None)
+    return (lambda text: len(tokenizer.encode(text, add_special_tokens=False))) if tokenizer else None
+
+def llm_signature(llm):
+    """
+    Get the model name and the generation parameters of an LLM, which determine its responses.
+    """
+    model = getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+    params = dict(getattr(llm, "generate_kwargs", None) or {})
+    for param in ["max_new_tokens", "temperature", "context_window", "system_prompt"]:
+        if getattr(llm, param, None) is not None:
+            params[param] = getattr(llm, param)
+    query_wrapper_prompt = getattr(llm, "query_wrapper_prompt", None)
+    if query_wrapper_prompt is not None:
+        params["query_wrapper_prompt"] = getattr(query_wrapper_prompt, "template", str(query_wrapper_prompt))
+    return model, params
+
+def response_pieces(query_engine, prompt, generation, cache=None, cancel=None):
+    """
+    Generates the response to a prompt piece by piece, see stream_response().
+    :param generation: GenerationStream iterating over these pieces. It is restarted before the
+        response is synthesized, and its stats() are recorded once the response is complete.
+    """
+    from llama_index.core import QueryBundle
+    # same as query_engine.query(), in steps
+    query_bundle = QueryBundle(prompt)
+    with span("retrieve") as attributes:
+        nodes = query_engine.retrieve(query_bundle)
+        attributes["nodes"] = len(nodes)
+    observe("retrieve.nodes", len(nodes))
+    key = None
+    if cache is not None:
+        model, params = llm_signature(Settings.llm)
+        key = response_key(prompt, [f"{node.node.node_id}:{node.node.hash}" for node in nodes], model, params)
+        cached = cache.get(key)
+        if cached is not None:
+            count("response_cache.hits")
+            yield cached
+            return
+        count("response_cache.misses")
+    if cancel is not None and cancel.is_set():
+        # cancelled while retrieving
+        return
+    # measured from here: without streaming, synthesize() already generates the whole response
+    generation.restart()
+    llm = Settings.llm
+    if getattr(llm, "_model", None) is not None and getattr(llm, "_tokenizer", None) is not None:
+        # formats the prompt with the retrieved context, and generates with this generation's cancel event
+        with span("synthesize"):
+            llm_prompt = format_llm_prompt(query_engine, prompt, nodes)
+        pieces = stream_generate(llm, llm_prompt, cancel)
+    else:
+        # formats the prompt with the retrieved context; without streaming, also generates the response
+        with span("synthesize"):
+            response = query_engine.synthesize(query_bundle, nodes)
+        if getattr(response, "response_gen", None) is None:
+            pieces = [str(response)]
+        else:
+            pieces = response.response_gen
+    yield from pieces
+    # a stopped generation is not measured nor cached, it ends early without an error
+    if cancel is None or not cancel.is_set():
+        record_generation(generation.stats())
+        if key is not None:
+            cache.put(key, generation.text)
+
+def stream_generate(llm, llm_prompt, cancel=None):
+    """
+    Generates the response to a formatted prompt token by token with the transformers model of a
+    HuggingFaceLLM, as its stream_complete() does, with a stopping criterion of its own.
+    :param cancel: threading.Event stopping this generation after the current token when set.
+        The generation also stops when the iteration is stopped, e.g. by close().
+    :return: Iterator of text pieces. Raises the error of the generation, if any.
+    """
+    import torch
+    from transformers import TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+    model, tokenizer = llm._model, llm._tokenizer
+    stopped = threading.Event()
+
+    class StopOnCancel(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            return stopped.is_set() or (cancel is not None and cancel.is_set())
+
+    inputs = tokenizer(llm_prompt, return_tensors="pt").to(model.device)
+    for key in getattr(llm, "tokenizer_outputs_to_remove", []):
+        inputs.pop(key, None)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors = []
+
+    def generate():
+        try:
+            with torch.no_grad():
+                model.generate(
+                    **inputs,
+                    streamer=streamer,
+                    max_new_tokens=llm.max_new_tokens,
+                    stopping_criteria=StoppingCriteriaList([StopOnCancel()]),
+                    pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+                    **llm.generate_kwargs,
+                )
+        except Exception as e:
+            errors.append(e)
+            # otherwise the streamer waits for the end forever
+            streamer.end()
+
+    thread = threading.Thread(target=generate, daemon=True)
+    thread.start()
+    try:
+        yield from streamer
+    finally:
+        stopped.set()
+    thread.join()
+    if errors:
+        raise errors[0]
+
+def record_generation(stats):
+    """
+    Records the stats() of a GenerationStream as the span "generate" and the values "generation.*".
+    """
+    metrics.record_span("generate", stats["total_time"], {"tokens": stats["tokens"]})
+    observe("generation.time_to_first_token", stats["time_to_first_token"])
+    observe("generation.tokens", stats["tokens"])
+    if stats["tokens_per_second"]:
+        observe("generation.tokens_per_second", stats["tokens_per_second"])
+    return
+
+
+def conversation_summarizer(llm=None):
+    """
+    Get a function summarizing the turns dropped from a ConversationMemory with an LLM.
+    :param llm: Defaults to the loaded LLM.
+    """
+    llm = llm or Settings.llm
 
+    def summarize(summary, text):
+        earlier = f"Summary of the earlier conversation: {summary}\n" if summary else ""
+        prompt = f"Summarize the following conversation in a few sentences, keeping the frames and the examples discussed.\n\n{earlier}{text}\n\nSummary:"
+        return llm.complete(prompt).text.strip()
+    return summarize
 
-def multi_conversation(query_engine):
-    previous_conversations = []
+def conversation_memory(query_engine, max_tokens=1024, summarize=False):
+    """
+    Creates the memory of a conversation with a query engine, counting tokens with the model's tokenizer.
+    :param max_tokens: Token budget of the history and the new prompt, see ConversationMemory.
+    :param summarize: Whether the oldest turns are summarized instead of dropped.
+    """
+    if isinstance(query_engine, RemoteQueryEngine):
+        # the model is in the server, the tokens are estimated
+        return ConversationMemory(max_tokens)
+    return ConversationMemory(max_tokens, token_counter(), conversation_summarizer() if summarize else None)
+
+
+def multi_conversation(query_engine, max_tokens=1024, summarize=False):
+    """
+    Chats with the query engine on the command line. Each prompt includes the previous turns, as
+    many as fit in max_tokens tokens.
+    :param summarize: Whether the oldest turns are summarized instead of dropped.
+    """
+    memory = conversation_memory(query_engine, max_tokens, summarize)
     while True:
         prompt = input(">>> Prompt: ")
-        previous_conversations.append({
-            "role": "user",
-            "content": prompt
-        })
-        formatted_conversations = "\n".join(
-            [f"User: {conv['content']}" if conv['role'] == "user" else f"Assistant: {conv['content']}" for conv in previous_conversations]
-        )
-        full_prompt = f"{formatted_conversations}\nUser: {prompt}\nAssistant:"
-        response = query_engine.query(full_prompt)
-        previous_conversations.append({
-            "role": "assistant",
-            "content": response
-        })
+        full_prompt = memory.prompt(prompt)
+        response = generate_response(query_engine, full_prompt, display=False)
+        memory.add("user", prompt)
+        memory.add("assistant", response)
         print(full_prompt)
         print(response)
     return 
 
-def multi_queries(query_engine, prompts:list=[], memory=False):
+def multi_queries(query_engine, prompts:list=[], memory=False, batched=False, batch_size=None, max_tokens=1024, summarize=False):
+    """
+    Asks several prompts in order.
+    :param memory: Whether each prompt includes the previous prompts and responses, as many as fit in
+        max_tokens tokens.
+    :param batched: Without memory, answer the prompts in batches with batch_queries(). Prompts
+        that fail get None as response and are reported.
+    :param batch_size: Number of prompts generated together when batched. Defaults to what fits in memory.
+    :param max_tokens: Token budget of the previous turns and the new prompt, with memory.
+    :param summarize: Whether the oldest turns are summarized instead of dropped, with memory.
+    :return: List of the user prompts and assistant responses.
+    """
+    if batched and not memory:
+        responses, failures = batch_queries(query_engine, prompts, batch_size)
+        for index, error in failures.items():
+            print(f"[Error] Prompt {index} failed: {error}")
+        if failures:
+            print(f"{len(prompts) - len(failures)}/{len(prompts)} prompts answered")
+        conversations = []
+        for prompt, response in zip(prompts, responses):
+            conversations.append({"role": "user", "content": prompt})
+            conversations.append({"role": "assistant", "content": response})
+        return conversations
+
     conversations = []
+    history = conversation_memory(query_engine, max_tokens, summarize) if memory else None
     for prompt in prompts:
+        full_prompt = history.prompt(prompt) if memory else prompt
+        response = generate_response(query_engine, full_prompt, display=False)
+        if memory:
+            history.add("user", prompt)
+            history.add("assistant", response)
         conversations.append({
             "role": "user",
             "content": prompt
         })
-        if memory:
-            formatted_conversations = "\n".join(
-                [f"User: {conv['content']}" if conv['role'] == "user" else f"Assistant: {conv['content']}" for conv in conversations]
-            )
-            full_prompt = f"{formatted_conversations}\nUser: {prompt}\nAssistant:"
-        else:
-            full_prompt = prompt
-        response = query_engine.query(full_prompt)
         conversations.append({
             "role": "assistant",
             "content": response
         })
     return conversations
+
+
+def batch_queries(query_engine, prompts: list, batch_size: int = None, max_batch_size: int = 16):
+    """
+    Answers independent prompts in batches. The contexts of all prompts are retrieved with one
+    embedding call, and the responses are generated several at a time, as query_engine.query()
+    would generate them one by one (retrieved nodes joined into a single question-answer prompt).
+    With a RemoteQueryEngine, the prompts are sent to the server one by one.
+    :param prompts: List of prompts.
+    :param batch_size: Number of prompts generated together. Defaults to what fits in the free memory.
+    :param max_batch_size: Largest batch size used when it is estimated from the free memory.
+    :return: (list of responses in the order of the prompts, with None for failed prompts;
+        dictionary mapping the index of each failed prompt to its error)
+    """
+    responses = [None] * len(prompts)
+    failures = {}
+    if not prompts:
+        return responses, failures
+    if isinstance(query_engine, RemoteQueryEngine):
+        # the model and the index are in the server, which answers the prompts one at a time
+        for i, prompt in enumerate(prompts):
+            try:
+                responses[i] = query_engine.query(prompt, use_cache=False)
+            except Exception as e:
+                failures[i] = e
+        return responses, failures
+    try:
+        with span("retrieve", prompts=len(prompts)):
+            llm_prompts = build_llm_prompts(query_engine, prompts)
+    except Exception as e:
+        return responses, {i: e for i in range(len(prompts))}
+
+    llm = Settings.llm
+    model = getattr(llm, "_model", None)
+    tokenizer = getattr(llm, "_tokenizer", None)
+    if model is None or tokenizer is None:
+        # not a local transformers model, generate one by one
+        for i, llm_prompt in enumerate(llm_prompts):
+            try:
+                responses[i] = llm.complete(llm_prompt, formatted=True).text
+            except Exception as e:
+                failures[i] = e
+        return responses, failures
+
+    # sort by length so that the prompts of a batch need little padding
+    lengths = [len(tokenizer.encode(llm_prompt)) for llm_prompt in llm_prompts]
+    order = sorted(range(len(prompts)), key=lambda i: lengths[i])
+    if batch_size is None:
+        batch_size = estimate_batch_size(model, max(lengths) + llm.max_new_tokens, max_batch_size)
+    start = 0
+    while start < len(order):
+        batch = order[start:start + batch_size]
+        try:
+            texts = generate_batch(llm, [llm_prompts[i] for i in batch])
+        except Exception as e:
+            if batch_size > 1 and "out of memory" in str(e).lower():
+                import torch
+                torch.cuda.empty_cache()
+                batch_size //= 2
+                continue
+            if len(batch) == 1:
+                failures[batch[0]] = e
+            else:
+                # retry the prompts one by one, so that only the failing ones are reported
+                for i in batch:
+                    try:
+                        responses[i] = generate_batch(llm, [llm_prompts[i]])[0]
+                    except Exception as single_error:
+                        failures[i] = single_error
+            start += len(batch)
+            continue
+        for i, text in zip(batch, texts):
+            responses[i] = text
+        start += len(batch)
+    return responses, failures
+
+def format_llm_prompt(query_engine, prompt, nodes):
+    """
+    Formats the full prompt given to the LLM from a prompt and its retrieved nodes, as
+    query_engine.query() does.
+    """
+    from llama_index.core.schema import MetadataMode
+
+    llm = Settings.llm
+    qa_template = query_engine.get_prompts()["response_synthesizer:text_qa_template"]
+    context = "\n\n".join(node.node.get_content(metadata_mode=MetadataMode.LLM) for node in nodes)
+    llm_prompt = qa_template.format(llm=llm, context_str=context, query_str=prompt)
+    # same as the LLM adds to the prompt in query_engine.query()
+    if llm.system_prompt:
+        llm_prompt = llm.system_prompt + "\n\n" + llm_prompt
+    if llm.query_wrapper_prompt:
+        llm_prompt = llm.query_wrapper_prompt.format(query_str=llm_prompt)
+    return llm_prompt
+
+def build_llm_prompts(query_engine, prompts):
+    """
+    Retrieves the context of each prompt and formats the full prompts given to the LLM.
+    """
+    from llama_index.core import QueryBundle
+
+    embed_model = Settings.embed_model
+    try:
+        from llama_index.embeddings.huggingface.utils import format_query
+        query_texts = [format_query(prompt, embed_model.model_name, embed_model.query_instruction) for prompt in prompts]
+    except (ImportError, AttributeError):
+        query_texts = prompts
+    embeddings = embed_model.get_text_embedding_batch(query_texts)
+
+    llm_prompts = []
+    for prompt, embedding in zip(prompts, embeddings):
+        nodes = query_engine.retriever.retrieve(QueryBundle(query_str=prompt, embedding=embedding))
+        llm_prompts.append(format_llm_prompt(query_engine, prompt, nodes))
+    return llm_prompts
+
+def estimate_batch_size(model, max_tokens, max_batch_size=16):
+    """
+    Estimates how many sequences of max_tokens tokens fit in the free memory of the model's device,
+    from the size of their keys and values. Half of the free memory is left for the activations.
+    """
+    import torch
+    config = model.config
+    element_size = torch.tensor([], dtype=model.dtype).element_size() if model.dtype.is_floating_point else 2
+    kv_heads_ratio = getattr(config, "num_key_value_heads", config.num_attention_heads) / config.num_attention_heads
+    bytes_per_sequence = 2 * config.num_hidden_layers * config.hidden_size * kv_heads_ratio * element_size * max_tokens
+    if model.device.type == "cuda":
+        free_memory = torch.cuda.mem_get_info(model.device)[0]
+    else:
+        free_memory = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    return max(1, min(max_batch_size, int(free_memory * 0.5 // bytes_per_sequence)))
+
+def generate_batch(llm, llm_prompts):
+    """
+    Generates the responses of several prompts at once with the transformers model of a HuggingFaceLLM.
+    """
+    import torch
+    model, tokenizer = llm._model, llm._tokenizer
+    padding_side, pad_token = tokenizer.padding_side, tokenizer.pad_token
+    tokenizer.padding_side = "left"
+    if pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    try:
+        inputs = tokenizer(llm_prompts, return_tensors="pt", padding=True).to(model.device)
+        pad_token_id = tokenizer.pad_token_id
+    finally:
+        # the tokenizer is shared with the other generations
+        tokenizer.padding_side = padding_side
+        tokenizer.pad_token = pad_token
+    for key in getattr(llm, "tokenizer_outputs_to_remove", []):
+        inputs.pop(key, None)
+    with torch.no_grad(), span("generate_batch", prompts=len(llm_prompts)):
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=llm.max_new_tokens,
+            pad_token_id=pad_token_id,
+            **llm.generate_kwargs,
+        )
+    return tokenizer.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
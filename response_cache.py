@@ -0,0 +1,104 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+RESPONSE_CACHE = "response_cache.sqlite"
+
+
+def normalize_prompt(prompt: str):
+    """
+    Normalizes a prompt for the cache key: whitespace differences do not change the key.
+    """
+    return " ".join(prompt.split())
+
+def response_key(prompt: str, context_ids: list, model: str, params: dict):
+    """
+    Computes the key of a response from everything that determines it.
+    :param prompt: Prompt sent to the query engine.
+    :param context_ids: Identifiers of the retrieved context, in the order they are given to the model.
+    :param model: Model name.
+    :param params: Generation parameters, e.g. temperature, top_k and the maximum number of tokens.
+    :return: Hex digest string.
+    """
+    content = json.dumps([normalize_prompt(prompt), list(context_ids), model, params], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class ResponseCache(object):
+    """
+    Cache of generated responses in a SQLite file. When the responses take more than max_bytes,
+    the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE, max_bytes: int = 64 << 20):
+        """
+        :param path: Path of the cache file, created if it does not exist.
+        :param max_bytes: Maximum total size of the cached responses.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_used REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+        return
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def size(self):
+        """
+        Get the total size of the cached responses in bytes.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str):
+        """
+        Get a cached response and mark it as recently used.
+        :param key: Key from response_key().
+        :return: Response text, or None if it is not cached.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        """
+        Caches a response, then evicts the least recently used responses over the size limit.
+        :param key: Key from response_key().
+        :param response: Response text.
+        """
+        size = len(response.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, size, time.time()))
+            total = self._conn.execute("SELECT SUM(size) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                evicted = 0
+                for old_key, old_size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                    if total - evicted <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    evicted += old_size
+            self._conn.commit()
+        return
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+        return
+
+    def close(self):
+        self._conn.close()
+        return